@@ -0,0 +1,223 @@
+# coding: utf-8
+"""
+Benchmark the data layer and the pages of MJPoll.
+
+Synthetic polls are generated for each number of ballots, number of choices and distribution of the grades:
+uniform random grades, or near ties where every choice has almost the same votes (the worst case of the ranking).
+Each benchmark keeps the best of several runs:
+
+  tally_python, tally_numpy  results computed from the tallies (numpy only if installed)
+  rank                       ranking of the choices from their votes count
+  cast                       a ballot cast by add_update_ballot
+  cast_threads               a ballot cast by add_update_ballot from one of 16 concurrent threads
+  page_list, page_ballot     pages rendered through the Flask test client
+  api_poll                   poll fetched from the JSON API
+  results_compute            results of the closed poll computed and stored (a single run)
+  results_read               stored results read by get_results
+  page_results               results page rendered without its cache
+
+  $ python bench.py
+  $ python bench.py --ballots 1000 1000000 --choices 2 8 --output new.json
+  $ python bench.py --compare old.json --output new.json
+  $ python bench.py --storage memory
+  $ python bench.py --group-commit 2
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import tempfile
+from datetime import datetime, timedelta
+
+import mjpoll
+
+DISTRIBUTIONS = ['uniform', 'tie']
+
+# Number of threads of the cast_threads benchmark
+CAST_THREADS = 16
+
+
+def grades(distribution, voter, choices_count, rng):
+    """:return: The grades of a voter for each choice"""
+    if distribution == 'uniform':
+        return [rng.randint(0, 6) for _ in range(choices_count)]
+
+    # Same grade for every choice but the first voters, who move choice i up a grade: the choices only differ by a
+    # few votes and the ranking has to remove most of the middle points to order them
+    grade = rng.randint(0, 5)
+    return [grade + 1 if voter < choice else grade for choice in range(choices_count)]
+
+
+def populate(ballots_count, choices_count, distribution='uniform', seed=0):
+    """
+    Create a poll owned by the user of the views with random ballots
+
+    :return: The poll from get_poll function
+    """
+    rng = random.Random(seed)
+
+    poll_uid = mjpoll.data.insert_poll(title='Benchmark', message='Benchmark poll', choices=['Choice %d' % i for i in range(choices_count)], end_date=datetime.now() + timedelta(3), owner=mjpoll.views.USER)
+    poll = mjpoll.data.get_poll(poll_uid)
+    choices = [choice['id'] for choice in poll['choices']]
+
+    def ballots():
+        for voter in xrange(ballots_count):
+            yield 'voter%d' % voter, dict(zip(choices, grades(distribution, voter, choices_count, rng)))
+
+    mjpoll.data.import_ballots(poll_uid, ballots())
+
+    return poll
+
+
+def timeit(function, repeat):
+    """:return: The best duration of function in seconds"""
+    durations = []
+    for _ in range(repeat):
+        start = time.time()
+        function()
+        durations.append(time.time() - start)
+    return min(durations)
+
+
+def get(client, url):
+    """Request a page and check it succeeded"""
+    rv = client.get(url)
+    assert rv.status_code == 200, '%s answered %d' % (url, rv.status_code)
+
+
+def bench_poll(ballots_count, choices_count, distribution, repeat, casts):
+    """
+    Run the benchmarks on a poll
+
+    :return: Duration in seconds of each benchmark and the number of operations it timed {name: (seconds, operations)}
+    """
+    timings = {}
+    poll = populate(ballots_count, choices_count, distribution)
+    votes = mjpoll.data.count_votes(poll)
+    client = mjpoll.app.test_client()
+
+    timings['tally_python'] = timeit(lambda: mjpoll.data.compute_results(mjpoll.data.count_votes(poll), ballots_count), repeat), 1
+
+    if mjpoll.data.numpy is not None:
+        def numpy_tally():
+            choices = sorted(votes)
+            mjpoll.data.compute_results_numpy(choices, mjpoll.data.numpy.array([mjpoll.data.count_votes(poll)[choice] for choice in choices]), ballots_count)
+        timings['tally_numpy'] = timeit(numpy_tally, repeat), 1
+
+    timings['rank'] = timeit(lambda: mjpoll.data.rank_choices(dict((choice, {'votes': counts}) for choice, counts in votes.items())), repeat), 1
+
+    def cast():
+        for voter in xrange(casts):
+            mjpoll.data.add_update_ballot('cast%d' % voter, poll['uid'], dict((choice, voter % 7) for choice in votes))
+    timings['cast'] = timeit(cast, repeat), casts
+
+    def cast_threads():
+        def cast_thread(thread):
+            with mjpoll.app.app_context():
+                for voter in xrange(thread, casts, CAST_THREADS):
+                    mjpoll.data.add_update_ballot('thread%d' % voter, poll['uid'], dict((choice, voter % 7) for choice in votes))
+
+        threads = [threading.Thread(target=cast_thread, args=(thread,)) for thread in range(CAST_THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    timings['cast_threads'] = timeit(cast_threads, repeat), casts
+
+    timings['page_list'] = timeit(lambda: get(client, '/list'), repeat), 1
+    timings['page_ballot'] = timeit(lambda: get(client, '/' + poll['uid']), repeat), 1
+    timings['api_poll'] = timeit(lambda: get(client, '/api/polls/' + poll['uid']), repeat), 1
+
+    mjpoll.data.set_poll_end_date(poll['uid'], datetime.now() - timedelta(1))
+
+    timings['results_compute'] = timeit(lambda: mjpoll.data.get_results(mjpoll.data.get_poll(poll['uid'])), 1), 1
+    timings['results_read'] = timeit(lambda: mjpoll.data.get_results(mjpoll.data.get_poll(poll['uid'])), repeat), 1
+
+    def results_page():
+        mjpoll.data.results_page_cache.clear()
+        get(client, '/' + poll['uid'])
+    timings['page_results'] = timeit(results_page, repeat), 1
+
+    return timings
+
+
+def key(result):
+    """:return: What identifies a benchmark between two runs"""
+    return result['name'], result['ballots'], result['choices'], result['distribution']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--ballots', type=int, nargs='+', default=[1000, 10000, 100000], help='number of ballots of each benchmarked poll')
+    parser.add_argument('--choices', type=int, nargs='+', default=[4], help='number of choices of the polls')
+    parser.add_argument('--distributions', nargs='+', choices=DISTRIBUTIONS, default=DISTRIBUTIONS, help='distributions of the grades of the polls')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs, the best one is kept')
+    parser.add_argument('--casts', type=int, default=200, help='number of ballots cast by each run of the cast benchmark')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='compare with the results of a previous run written by --output')
+    parser.add_argument('--storage', choices=sorted(mjpoll.data.STORAGES), default=mjpoll.app.config['STORAGE'], help='storage of the polls (default: %(default)s)')
+    parser.add_argument('--group-commit', type=int, default=mjpoll.app.config['GROUP_COMMIT_INTERVAL'], metavar='MS', help='commit the ballots cast during MS milliseconds together (default: %(default)s)')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='slowdown above which a comparison fails (default: %(default)s)')
+    args = parser.parse_args()
+    mjpoll.app.config['STORAGE'] = args.storage
+    mjpoll.app.config['GROUP_COMMIT_INTERVAL'] = args.group_commit
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline.get('storage', 'sqlite') != args.storage:
+            print 'Warning: the baseline was run with the %s storage' % baseline.get('storage', 'sqlite')
+        baseline = dict((key(result), result) for result in baseline['results'])
+
+    results = []
+    regressions = 0
+
+    print '%-16s %9s %8s %-13s %12s %12s' % ('benchmark', 'ballots', 'choices', 'distribution', 'per op (ms)', 'ratio' if baseline else '')
+    for distribution in args.distributions:
+        for choices_count in args.choices:
+            for ballots_count in args.ballots:
+                db_fd, mjpoll.app.config['DATABASE'] = tempfile.mkstemp()
+                try:
+                    mjpoll.init_db()
+                    with mjpoll.app.app_context():
+                        timings = bench_poll(ballots_count, choices_count, distribution, args.repeat, args.casts)
+                finally:
+                    mjpoll.data.stop_ballot_writer()
+                    if args.storage == 'memory':
+                        mjpoll.data.get_storage().clear()
+                    mjpoll.data.close_pool()
+                    os.close(db_fd)
+                    for suffix in ('', '-wal', '-shm'):
+                        if os.path.exists(mjpoll.app.config['DATABASE'] + suffix):
+                            os.unlink(mjpoll.app.config['DATABASE'] + suffix)
+
+                for name in sorted(timings):
+                    seconds, operations = timings[name]
+                    result = {'name': name, 'ballots': ballots_count, 'choices': choices_count, 'distribution': distribution, 'seconds': seconds, 'operations': operations}
+                    results.append(result)
+
+                    ratio = ''
+                    if key(result) in baseline:
+                        previous = baseline[key(result)]
+                        ratio = (seconds / operations) / max(previous['seconds'] / previous['operations'], 1e-9)
+                        if ratio > 1 + args.tolerance:
+                            regressions += 1
+                        ratio = '%.2f%s' % (ratio, ' !' if ratio > 1 + args.tolerance else '')
+
+                    print '%-16s %9d %8d %-13s %12.3f %12s' % (name, ballots_count, choices_count, distribution, 1000 * seconds / operations, ratio)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'date': datetime.now().isoformat(), 'python': sys.version.split()[0], 'numpy': mjpoll.data.numpy is not None, 'storage': args.storage, 'group_commit': args.group_commit, 'results': results}, output, indent=1, sort_keys=True)
+
+    if regressions:
+        sys.exit('%d benchmarks slower than the baseline by more than %d%%' % (regressions, 100 * args.tolerance))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+# coding: utf-8
+"""
+Load test a running MJPoll server with concurrent voters.
+
+Each voter is a thread with its own connection, which loads the ballot page of the poll and casts a ballot in a loop.
+Idle connections which never finish their request can be held open meanwhile, like slow clients: each one takes a
+thread of the threaded server but only a greenlet of the asynchronous one.
+
+  $ python -m mjpoll.cli serve --async &
+  $ python loadtest.py --voters 200 --idle 2000 --duration 30
+
+Without a poll uid, a poll is created in the databases of the configuration, which the server must share.
+"""
+
+import sys
+import json
+import time
+import random
+import socket
+import urllib
+import argparse
+import httplib
+import threading
+import urlparse
+from datetime import datetime, timedelta
+from collections import defaultdict
+
+import mjpoll
+
+
+def create_poll(choices_count):
+    """:return: The uid of a new poll open for a day"""
+    mjpoll.init_db()
+    with mjpoll.app.app_context():
+        return mjpoll.data.insert_poll(title='Load test', message='Load test poll', choices=['Choice %d' % i for i in range(choices_count)], end_date=datetime.now() + timedelta(1), owner=mjpoll.views.USER)
+
+
+def request(connection, method, path, body=None, headers={}):
+    """:return: The status of the response and its body"""
+    connection.request(method, path, body, headers)
+    response = connection.getresponse()
+    return response.status, response.read()
+
+
+def percentile(durations, fraction):
+    return durations[min(int(fraction * len(durations)), len(durations) - 1)] if durations else 0
+
+
+class Voter(threading.Thread):
+    """Load the ballot page and cast a ballot until the deadline, recording the duration of each request by name"""
+
+    def __init__(self, host, port, poll, choices, deadline, seed):
+        super(Voter, self).__init__()
+        self.daemon = True
+        self.host, self.port = host, port
+        self.poll, self.choices = poll, choices
+        self.deadline = deadline
+        self.rng = random.Random(seed)
+        self.durations = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def timed(self, connection, name, method, path, body=None, headers={}):
+        start = time.time()
+        try:
+            status, _ = request(connection, method, path, body, headers)
+        except (socket.error, httplib.HTTPException):
+            connection.close()
+            status = None
+        self.durations[name].append(time.time() - start)
+        if status not in (200, 302):
+            self.errors[name] += 1
+
+    def run(self):
+        connection = httplib.HTTPConnection(self.host, self.port, timeout=60)
+        while time.time() < self.deadline:
+            self.timed(connection, 'ballot', 'GET', '/' + self.poll)
+            form = dict(('choice_%d' % choice, self.rng.randint(0, 6)) for choice in self.choices)
+            form['poll'] = self.poll
+            self.timed(connection, 'cast', 'POST', '/cast', urllib.urlencode(form), {'Content-Type': 'application/x-www-form-urlencoded'})
+        connection.close()
+
+
+def hold_idle(host, port, count):
+    """:return: Sockets connected to the server with an unfinished request"""
+    sockets = []
+    for _ in range(count):
+        try:
+            idle = socket.create_connection((host, port), timeout=10)
+            idle.sendall('GET / HTTP/1.1\r\nHost: %s\r\n' % host)
+            sockets.append(idle)
+        except socket.error as error:
+            print 'Only %d idle connections opened: %s' % (len(sockets), error)
+            break
+    return sockets
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('poll', nargs='?', help='uid of the poll (default: a new poll)')
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help='address of the server (default: %(default)s)')
+    parser.add_argument('--voters', type=int, default=50, help='number of concurrent voters (default: %(default)s)')
+    parser.add_argument('--idle', type=int, default=0, help='number of idle connections held open during the test')
+    parser.add_argument('--duration', type=float, default=10, help='number of seconds of the test (default: %(default)s)')
+    parser.add_argument('--choices', type=int, default=4, help='number of choices of a new poll (default: %(default)s)')
+    args = parser.parse_args()
+
+    url = urlparse.urlparse(args.url)
+    host, port = url.hostname, url.port or 80
+
+    poll = args.poll or create_poll(args.choices)
+    status, body = request(httplib.HTTPConnection(host, port, timeout=10), 'GET', '/api/polls/' + poll)
+    if status != 200:
+        sys.exit('Poll %s not found on %s (%d)' % (poll, args.url, status))
+    choices = [choice['id'] for choice in json.loads(body)['choices']]
+
+    idle = hold_idle(host, port, args.idle)
+
+    start = time.time()
+    voters = [Voter(host, port, poll, choices, start + args.duration, seed) for seed in range(args.voters)]
+    for voter in voters:
+        voter.start()
+    for voter in voters:
+        voter.join()
+    elapsed = time.time() - start
+
+    for connection in idle:
+        connection.close()
+
+    print '%d voters, %d idle connections, %.1f s' % (args.voters, len(idle), elapsed)
+    print '%-8s %9s %9s %7s %9s %9s %9s' % ('request', 'count', 'per s', 'errors', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)')
+    for name in ('ballot', 'cast'):
+        durations = sorted(duration for voter in voters for duration in voter.durations[name])
+        errors = sum(voter.errors[name] for voter in voters)
+        print '%-8s %9d %9.1f %7d %9.1f %9.1f %9.1f' % (name, len(durations), len(durations) / elapsed, errors,
+                                                        1000 * percentile(durations, 0.5), 1000 * percentile(durations, 0.95), 1000 * percentile(durations, 0.99))
+
+
+if __name__ == '__main__':
+    main()
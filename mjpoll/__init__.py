@@ -14,5 +14,7 @@ babel = Babel(app)
 Bootstrap(app)
 
 import views
+import api
+import metrics
 import data
 from data import init_db
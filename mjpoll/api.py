@@ -0,0 +1,113 @@
+# coding: utf-8
+"""
+JSON API of the polls, for the clients which only need the data.
+
+  GET  /api/polls/<poll>          The poll and the ballot of the user
+  POST /api/polls/<poll>/ballot   Cast or update the ballot of the user: {"grades": {"<choice id>": <grade>,}}
+  GET  /api/polls/<poll>/results  The results of a closed poll, or the live results of an open poll for its owner
+  GET  /api/polls/<poll>/voters   A page of the voters of an open poll by name, the next one starts after the name given
+                                  by next: ?after=<next>
+
+Errors are answered with their HTTP status and {"error": message}.
+"""
+
+from flask import request, jsonify
+
+from mjpoll import app
+from views import USER, choices_by_rank
+from data import get_poll, get_results, get_live_results, get_voter_ballot, add_update_ballot, get_ballot_voters, count_voters, GRADES
+
+
+def error(status, message):
+    """:return: A JSON error response"""
+    response = jsonify(error=message)
+    response.status_code = status
+    return response
+
+
+def json_ballot(ballot):
+    """:return: The grades of a ballot by choice id, as JSON keys are strings"""
+    return dict((str(choice), grade) for choice, grade in ballot.items()) if ballot is not None else None
+
+
+@app.route('/api/polls/<poll>')
+def api_poll(poll):
+    poll = get_poll(poll)
+
+    if poll is None:
+        return error(404, 'Poll not found')
+
+    return jsonify(uid=poll['uid'],
+                   title=poll['title'],
+                   message=poll['message'],
+                   end_date=poll['end_date'].isoformat(),
+                   closed=poll['closed'],
+                   choices=[{'id': choice['id'], 'text': choice['text']} for choice in poll['choices']],
+                   ballot=json_ballot(get_voter_ballot(USER, poll['uid'])) if not poll['closed'] else None,
+                   voters=count_voters(poll) if not poll['closed'] else None)
+
+
+@app.route('/api/polls/<poll>/ballot', methods=['POST'])
+def api_cast(poll):
+    poll = get_poll(poll)
+
+    if poll is None:
+        return error(404, 'Poll not found')
+
+    if poll['closed']:
+        return error(409, 'Poll closed')
+
+    data = request.get_json(silent=True)
+    try:
+        choices = dict((int(choice), grade) for choice, grade in data['grades'].items())
+    except (TypeError, KeyError, ValueError, AttributeError):
+        return error(400, 'Invalid ballot, expected {"grades": {"<choice id>": <grade>,}}')
+
+    if not add_update_ballot(voter=USER, poll=poll['uid'], choices=choices):
+        # The poll may have closed since it was read
+        poll = get_poll(poll['uid'])
+        if poll is None or poll['closed']:
+            return error(409, 'Poll closed')
+        return error(400, 'Invalid ballot, each choice of the poll needs a grade from 0 to %d' % (len(GRADES) - 1))
+
+    return jsonify(ballot=json_ballot(choices))
+
+
+@app.route('/api/polls/<poll>/results')
+def api_results(poll):
+    poll = get_poll(poll)
+
+    if poll is None:
+        return error(404, 'Poll not found')
+
+    if not poll['closed'] and (not app.config['LIVE_RESULTS'] or poll['owner'] != USER):
+        return error(403, 'Poll not closed')
+
+    results = get_results(poll) if poll['closed'] else get_live_results(poll)
+
+    if results is None:
+        return error(404, 'Poll without results')
+
+    ranking = []
+    for choice in choices_by_rank(results):
+        result = results[choice]
+        ranking.append({'choice': choice,
+                        'rank': result['rank'][0] if isinstance(result['rank'], list) else result['rank'],
+                        'ties': result['rank'] if isinstance(result['rank'], list) else [],
+                        'grade': result['grade'],
+                        'percentages': result['percentages']})
+
+    return jsonify(closed=poll['closed'], ballots=results.values()[0]['ballots'], results=ranking)
+
+
+@app.route('/api/polls/<poll>/voters')
+def api_voters(poll):
+    poll = get_poll(poll)
+
+    if poll is None:
+        return error(404, 'Poll not found')
+
+    limit = app.config['VOTERS_PAGE_SIZE']
+    voters = get_ballot_voters(poll['uid'], request.args.get('after'), limit) or []
+
+    return jsonify(voters=voters, next=voters[-1] if len(voters) == limit else None)
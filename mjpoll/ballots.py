@@ -0,0 +1,89 @@
+# coding: utf-8
+"""
+Read the ballots of a poll from files.
+
+In CSV files, the first row names the choices after the voter column:
+
+  voter,Rabbit,Hare
+  alice,Excellent,Poor
+  bob,6,1
+
+In JSON lines files, each line is a ballot:
+
+  {"voter": "alice", "grades": {"Rabbit": "Excellent", "Hare": "Poor"}}
+
+Choices are given by their text or their id, grades by their name or their number (0 to 6).
+"""
+
+import csv
+import json
+
+from mjpoll.data import GRADES
+
+
+def choice_lookup(poll):
+    """:return: The ids of the choices of the poll by text and by id"""
+    lookup = {}
+    for choice in poll['choices']:
+        lookup[choice['text']] = choice['id']
+        lookup[unicode(choice['id'])] = choice['id']
+    return lookup
+
+
+def grade_lookup():
+    """:return: The grades by name and by number"""
+    lookup = {}
+    for grade, name in enumerate(GRADES):
+        lookup[name.lower()] = grade
+        lookup[unicode(grade)] = grade
+    return lookup
+
+
+def read_csv(poll, lines):
+    """
+    Read the ballots of a CSV file, unknown choices and grades are read as None for the import to reject the ballot
+
+    :param poll: Poll from get_poll function
+    :param lines: Lines of the file, utf-8 encoded
+    :return: Voters associated with their choices and grades
+    :rtype: generator of (voter, {choice_id: grade,})
+    """
+    choices = choice_lookup(poll)
+    grades = grade_lookup()
+
+    reader = csv.reader(lines)
+    header = [cell.decode('utf-8').strip() for cell in next(reader, [])]
+    columns = [choices.get(text) for text in header[1:]]
+
+    for row in reader:
+        if not row:
+            continue
+        row = [cell.decode('utf-8').strip() for cell in row]
+        yield row[0], dict((choice, grades.get(grade.lower())) for choice, grade in zip(columns, row[1:]) if grade)
+
+
+def read_jsonl(poll, lines):
+    """
+    Read the ballots of a JSON lines file, unknown choices and grades are read as None for the import to reject the ballot
+
+    :param poll: Poll from get_poll function
+    :param lines: Lines of the file
+    :return: Voters associated with their choices and grades
+    :rtype: generator of (voter, {choice_id: grade,})
+    """
+    choices = choice_lookup(poll)
+    grades = grade_lookup()
+
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            ballot = json.loads(line)
+            voter, grades_by_choice = ballot['voter'], ballot['grades'].items()
+        except (ValueError, KeyError, TypeError, AttributeError):
+            # Malformed line, the import rejects a ballot without voter
+            voter, grades_by_choice = None, []
+        yield voter, dict((choices.get(unicode(choice)), grades.get(unicode(grade).lower())) for choice, grade in grades_by_choice)
+
+
+READERS = {'csv': read_csv, 'jsonl': read_jsonl}
@@ -0,0 +1,60 @@
+# coding: utf-8
+"""In-process caches"""
+
+import time
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Thread safe cache keeping the most recently used entries.
+
+    :param size: Maximum number of entries, 0 disables the cache
+    :param ttl: Number of seconds after which an entry expires, None to keep entries until they are evicted
+    """
+
+    def __init__(self, size, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """:return: The value cached for the key or default if it is missing or expired"""
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return default
+
+            value, expiration = entry
+            if expiration is not None and expiration < time.time():
+                return default
+
+            # Move the entry to the most recently used end
+            self.entries[key] = entry
+            return value
+
+    def set(self, key, value):
+        """Cache a value, evicting the least recently used entries if the cache is full"""
+        if self.size <= 0:
+            return
+
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, time.time() + self.ttl if self.ttl is not None else None)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def pop(self, key):
+        """Remove an entry from the cache"""
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        """Remove all the entries of the cache"""
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
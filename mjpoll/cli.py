@@ -0,0 +1,152 @@
+# coding: utf-8
+"""
+Command line administration of MJPoll
+
+  $ python -m mjpoll.cli init
+  $ python -m mjpoll.cli close --watch
+  $ python -m mjpoll.cli import POLL ballots.csv
+  $ python -m mjpoll.cli export --format jsonl > results.jsonl
+  $ python -m mjpoll.cli rebalance --from 1
+  $ python -m mjpoll.cli serve --async
+"""
+
+import os
+import sys
+import time
+import argparse
+import logging
+
+from mjpoll import app
+from mjpoll.data import init_db, close_polls, Closer, get_poll, import_ballots, export_results, rebalance as rebalance_polls, shard_path
+from mjpoll.ballots import READERS
+from mjpoll.export import WRITERS
+from mjpoll.server import serve_async
+
+
+def init(args):
+    """Create or upgrade the database"""
+    init_db()
+
+
+def close(args):
+    """Compute the results of the ended polls"""
+    if args.watch:
+        closer = Closer(args.interval)
+        closer.start()
+        try:
+            while closer.is_alive():
+                time.sleep(1)
+        except KeyboardInterrupt:
+            closer.stop()
+    else:
+        with app.app_context():
+            for poll in close_polls():
+                print 'Results computed for poll %s' % poll
+
+
+def import_(args):
+    """Add or replace ballots of a poll from a CSV or JSON lines file"""
+    file_format = args.format or os.path.splitext(args.file)[1].lstrip('.').lower()
+    if file_format not in READERS:
+        sys.exit('Unknown format %s, use --format' % file_format)
+
+    start = time.time()
+
+    def progress(imported, rejected):
+        sys.stderr.write('\r%d ballots imported, %d rejected (%d ballots/s)' % (imported, rejected, imported / max(time.time() - start, 0.001)))
+
+    with app.app_context():
+        poll = get_poll(args.poll)
+        if poll is None or poll['closed'] is True:
+            sys.exit('Poll %s does not exist or is closed' % args.poll)
+
+        with open(args.file, 'rb') as lines:
+            imported, rejected = import_ballots(args.poll, READERS[file_format](poll, lines), args.batch_size, progress)
+
+    sys.stderr.write('\n')
+    print '%d ballots imported, %d rejected in %.1f s' % (imported, rejected, time.time() - start)
+
+
+def export(args):
+    """Write the results of closed polls as CSV, JSON or JSON lines"""
+    output = open(args.output, 'wb') if args.output else sys.stdout
+    try:
+        with app.app_context():
+            for chunk in WRITERS[args.format](export_results(args.polls or None)):
+                output.write(chunk)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+def rebalance(args):
+    """Move the polls to their database after a change of DATABASE_SHARDS"""
+    init_db()
+
+    moved = 0
+    with app.app_context():
+        for poll in rebalance_polls(args.shards):
+            moved += 1
+            app.logger.info('Poll %s moved', poll)
+
+    print '%d polls moved' % moved
+    for shard in range(app.config['DATABASE_SHARDS'], args.shards):
+        print '%s is no longer used' % shard_path(shard)
+
+
+def serve(args):
+    """Serve the application"""
+    if args.async_:
+        try:
+            serve_async(args.host, args.port, args.threads)
+        except RuntimeError as error:
+            sys.exit(str(error))
+        except KeyboardInterrupt:
+            pass
+    else:
+        app.run(args.host, args.port, threaded=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m mjpoll.cli', description='MJPoll administration')
+    subparsers = parser.add_subparsers()
+
+    parser_init = subparsers.add_parser('init', help=init.__doc__)
+    parser_init.set_defaults(command=init)
+
+    parser_close = subparsers.add_parser('close', help=close.__doc__)
+    parser_close.add_argument('--watch', action='store_true', help='keep running and compute the results of the polls when they end')
+    parser_close.add_argument('--interval', type=float, default=10, help='number of seconds between two checks of the ended polls (default: %(default)s)')
+    parser_close.set_defaults(command=close)
+
+    parser_import = subparsers.add_parser('import', help=import_.__doc__)
+    parser_import.add_argument('poll', help='uid of the poll')
+    parser_import.add_argument('file', help='file of the ballots')
+    parser_import.add_argument('--format', choices=sorted(READERS), help='format of the file (default: its extension)')
+    parser_import.add_argument('--batch-size', type=int, help='number of ballots written by each transaction (default: IMPORT_BATCH_SIZE)')
+    parser_import.set_defaults(command=import_)
+
+    parser_export = subparsers.add_parser('export', help=export.__doc__)
+    parser_export.add_argument('polls', nargs='*', metavar='poll', help='uid of a poll (default: all the closed polls)')
+    parser_export.add_argument('--format', choices=sorted(WRITERS), default='csv', help='format of the output (default: %(default)s)')
+    parser_export.add_argument('--output', help='file of the output (default: the standard output)')
+    parser_export.set_defaults(command=export)
+
+    parser_rebalance = subparsers.add_parser('rebalance', help=rebalance.__doc__)
+    parser_rebalance.add_argument('--from', dest='shards', type=int, required=True, help='previous value of DATABASE_SHARDS')
+    parser_rebalance.set_defaults(command=rebalance)
+
+    parser_serve = subparsers.add_parser('serve', help=serve.__doc__)
+    parser_serve.add_argument('--host', default='127.0.0.1', help='address to listen on (default: %(default)s)')
+    parser_serve.add_argument('--port', type=int, default=5000, help='port to listen on (default: %(default)s)')
+    parser_serve.add_argument('--async', dest='async_', action='store_true', help='hold the connections with gevent and run the application in a pool of threads')
+    parser_serve.add_argument('--threads', type=int, help='number of threads of the pool (default: SERVER_THREADS)')
+    parser_serve.set_defaults(command=serve)
+
+    args = parser.parse_args(argv)
+    args.command(args)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -3,99 +3,627 @@
 
 import sqlite3
 import os
-import copy
-import math
+import zlib
+import threading
+import time
+import Queue
 from uuid import uuid4
 from datetime import datetime
 from collections import defaultdict
+from contextlib import contextmanager
 
 from flask import g
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 from mjpoll import app
+from mjpoll.cache import LRUCache
+from mjpoll.markup import md_message, md_choice
+from mjpoll.metrics import Phase, InstrumentedConnection
+from mjpoll.storage import Storage, MemoryStorage
 
 app.config['DATABASE'] = os.path.realpath(os.path.join(app.root_path, '../data/mjpoll.db'))
 
+# Polls by uid, they never change once created
+poll_cache = LRUCache(app.config['POLL_CACHE_SIZE'], app.config['POLL_CACHE_TTL'])
 
-def get_db():
-    """Give access to the database"""
+# Rendered results pages of the closed polls, by uid then by locale
+results_page_cache = LRUCache(app.config['RESULTS_PAGE_CACHE_SIZE'], app.config['RESULTS_PAGE_CACHE_TTL'])
 
-    db = getattr(g, '_database', None)
-    if db is None:
-        if not os.path.exists(os.path.dirname(app.config['DATABASE'])):
-            os.mkdir(os.path.dirname(app.config['DATABASE']))
+# Locks serializing the computation of the results in the process, a poll always uses the same one
+results_locks = [threading.Lock() for _ in range(64)]
+
+# Grades from the worst (0) to the best (6)
+GRADES = ["To reject", "Poor", "Acceptable", "Fair", "Good", "Very Good", "Excellent"]
+
+# Columns of the results table holding the number of votes of each grade
+GRADE_COLUMNS = ["to_reject", "poor", "acceptable", "fair", "good", "very_good", "excellent"]
+
+
+# Connections kept open by each thread, by database path
+pool = threading.local()
+
+
+def connect(database):
+    """Open a connection to a database with the configured settings"""
+
+    if not os.path.exists(os.path.dirname(database)):
+        os.mkdir(os.path.dirname(database))
+
+    factory = InstrumentedConnection if app.config['INSTRUMENTATION'] else sqlite3.Connection
+    db = sqlite3.connect(database, detect_types=sqlite3.PARSE_DECLTYPES, timeout=app.config['DATABASE_BUSY_TIMEOUT'] / 1000.0, cached_statements=app.config['DATABASE_CACHED_STATEMENTS'], factory=factory)
+    db.row_factory = sqlite3.Row
+    # Enable foreign key verifications
+    db.execute('pragma foreign_keys=ON')
+    db.execute('pragma journal_mode=%s' % app.config['DATABASE_JOURNAL_MODE'])
+    db.execute('pragma synchronous=%s' % app.config['DATABASE_SYNCHRONOUS'])
+    db.execute('pragma cache_size=%d' % app.config['DATABASE_CACHE_SIZE'])
+    return db
+
+
+def acquire_connection(database):
+    """
+    Get a connection to a database from the pool of the current thread, or a new one if the pool is disabled.
+
+    Connections must be given back with release_connection.
+    """
+
+    if not app.config['DATABASE_POOL']:
+        return connect(database)
+
+    # A forked process must not share the connections of its parent
+    if getattr(pool, 'pid', None) != os.getpid():
+        pool.pid = os.getpid()
+        pool.connections = {}
+
+    if database not in pool.connections:
+        pool.connections[database] = [connect(database), 0]
+
+    pool.connections[database][1] += 1
+    return pool.connections[database][0]
+
+
+def release_connection(db):
+    """Give back a connection acquired with acquire_connection, uncommitted changes are discarded"""
+
+    for connection in getattr(pool, 'connections', {}).values():
+        if connection[0] is db:
+            connection[1] -= 1
+            if connection[1] == 0:
+                db.rollback()
+            return
+
+    db.close()
+
+
+def close_pool():
+    """Close the connections kept open by the current thread"""
+
+    for db, _ in getattr(pool, 'connections', {}).values():
+        db.close()
+    pool.connections = {}
+
+
+def shard_path(shard):
+    """:return: Path of the database of a shard, the first one is DATABASE and the others are numbered after it"""
+
+    if shard == 0:
+        return app.config['DATABASE']
+
+    root, extension = os.path.splitext(app.config['DATABASE'])
+    return '%s-%d%s' % (root, shard, extension)
+
+
+def shard_of(poll):
+    """
+    :param poll: UID of a poll
+    :return: Index of the shard storing the poll with its choices, ballots and results
+    """
+
+    if isinstance(poll, unicode):
+        poll = poll.encode('utf-8')
+    return (zlib.crc32(poll) & 0xffffffff) % app.config['DATABASE_SHARDS']
 
-        db = g._database = sqlite3.connect(app.config['DATABASE'], detect_types=sqlite3.PARSE_DECLTYPES)
-        db.row_factory = sqlite3.Row
-        # Enable foreign key verifications
-        db.execute('pragma foreign_keys=ON')
+
+def get_db(poll=None, shard=None):
+    """
+    Give access to the database of the shard of a poll
+
+    :param poll: UID of the poll, None for the first shard
+    :param shard: Index of the shard, instead of a poll
+    """
+
+    if shard is None:
+        shard = shard_of(poll) if poll is not None else 0
+
+    databases = getattr(g, '_databases', None)
+    if databases is None:
+        databases = g._databases = {}
+
+    db = databases.get(shard)
+    if db is None:
+        db = databases[shard] = acquire_connection(shard_path(shard))
     return db
 
 
+def get_dbs():
+    """Give access to the databases of all the shards"""
+
+    return [get_db(shard=shard) for shard in range(app.config['DATABASE_SHARDS'])]
+
+
 @app.teardown_appcontext
 def close_connection(exception):
-    """When the application exit, close the database"""
-    db = getattr(g, '_database', None)
-    if db is not None:
-        db.close()
+    """When the application exit, give back the database connections"""
+    for db in getattr(g, '_databases', {}).values():
+        release_connection(db)
+
+
+# Migrations upgrading databases created from an older schema.sql, in order.
+# The number of migrations applied to a database is stored in its user_version. Each migration runs in the transaction
+# of migrate, so it must not use executescript which commits.
+MIGRATIONS = []
+
+
+def migration(function):
+    """Register a migration of the database schema"""
+    MIGRATIONS.append(function)
+    return function
+
+
+@migration
+def migrate_tallies(db):
+    """Add the tallies of the ballots"""
+    db.execute("""
+        CREATE TABLE tallies (
+          poll   TEXT NOT NULL,
+          choice INTEGER NOT NULL,
+          grade  INTEGER NOT NULL,
+          count  INTEGER NOT NULL,
+          FOREIGN KEY(poll) REFERENCES polls(uid),
+          FOREIGN KEY(choice) REFERENCES choices(id),
+          PRIMARY KEY (poll, choice, grade)
+        )
+    """)
+    db.execute("INSERT INTO tallies (poll, choice, grade, count) SELECT poll, choice, grade, COUNT(*) FROM ballots GROUP BY poll, choice, grade")
+
+
+@migration
+def migrate_indexes(db):
+    """Add the indexes of the polls, choices and ballots lookups"""
+    db.execute("CREATE INDEX polls_owner ON polls (owner)")
+    db.execute("CREATE INDEX choices_poll ON choices (poll, id)")
+    db.execute("CREATE INDEX ballots_poll ON ballots (poll, voter, choice, grade)")
+
+
+@migration
+def migrate_end_date_index(db):
+    """Add the index of the polls by end date"""
+    db.execute("CREATE INDEX polls_end_date ON polls (end_date)")
+
+
+@migration
+def migrate_typed_results(db):
+    """Store the results with integer ranks, the ties apart, binary percentages and the votes count"""
+    db.execute("ALTER TABLE results RENAME TO text_results")
+    db.execute("""
+        CREATE TABLE results (
+          poll         TEXT NOT NULL,
+          choice       INTEGER NOT NULL,
+          rank         INTEGER NOT NULL,
+          grade        TEXT NOT NULL,
+          percentages  BLOB NOT NULL,
+          ballots      INTEGER NOT NULL,
+          to_reject    INTEGER,
+          poor         INTEGER,
+          acceptable   INTEGER,
+          fair         INTEGER,
+          good         INTEGER,
+          very_good    INTEGER,
+          excellent    INTEGER,
+          FOREIGN KEY(poll) REFERENCES polls(uid),
+          FOREIGN KEY(choice) REFERENCES choices(id),
+          PRIMARY KEY (poll, choice)
+        )
+    """)
+    db.execute("""
+        CREATE TABLE ties (
+          poll    TEXT NOT NULL,
+          choice  INTEGER NOT NULL,
+          rank    INTEGER NOT NULL,
+          FOREIGN KEY(poll, choice) REFERENCES results(poll, choice),
+          PRIMARY KEY (poll, choice, rank)
+        )
+    """)
+
+    # The votes count was not stored
+    for result in db.execute('SELECT * FROM text_results').fetchall():
+        ranks = [int(rank) for rank in result['rank'].split(';')]
+        percentages = bytearray(int(percentage) for percentage in result['percentages'].split(';'))
+        db.execute('INSERT INTO results (poll, choice, rank, grade, percentages, ballots) VALUES (?, ?, ?, ?, ?, ?)', [result['poll'], result['choice'], ranks[0], result['grade'], sqlite3.Binary(percentages), result['ballots']])
+        if ';' in result['rank']:
+            db.executemany('INSERT INTO ties (poll, choice, rank) VALUES (?, ?, ?)', [(result['poll'], result['choice'], rank) for rank in ranks])
+
+    db.execute('DROP TABLE text_results')
+
+
+@migration
+def migrate_html(db):
+    """Store the HTML of the messages and the choices"""
+    db.execute("ALTER TABLE polls ADD COLUMN message_html TEXT")
+    db.execute("ALTER TABLE choices ADD COLUMN html TEXT")
+
+
+def migrate(db, version):
+    """
+    Apply a migration and record it in the user_version of the database, in a single transaction rolled back on failure
+
+    :param version: Index of the migration in MIGRATIONS
+    """
+    # The sqlite3 module commits before the schema statements unless the transactions are handled manually
+    isolation_level = db.isolation_level
+    db.isolation_level = None
+    try:
+        db.execute('BEGIN')
+        try:
+            MIGRATIONS[version](db)
+            db.execute('PRAGMA user_version = %d' % (version + 1))
+            db.execute('COMMIT')
+        except:
+            db.execute('ROLLBACK')
+            raise
+    finally:
+        db.isolation_level = isolation_level
 
 
 def init_db():
     """
-    Can be called in python interpreter to create the database:
-    >>> from mjpoll.db import init
-    >>> init()
+    Can be called in python interpreter to create the database or upgrade an existing one:
+    >>> import mjpoll.data
+    >>> mjpoll.data.init_db()
     """
 
-    with app.app_context():
-        db = get_db()
-        with app.open_resource('schema.sql', mode='r') as f:
-            db.cursor().executescript(f.read())
-        db.commit()
+    get_storage().init()
+
 
+def query_read(query, args=(), one=False, poll=None, db=None):
+    """
+    Execute a read query on the database and retrieve the data
 
-def query_read(query, args=(), one=False):
-    """Execute a read query on the database and retrieve the data"""
-    cur = get_db().execute(query, args)
+    :param poll: UID of the poll whose shard is queried, the first shard by default
+    :param db: Connection to query instead of the shard of a poll
+    """
+    cur = (db or get_db(poll)).execute(query, args)
     rv = cur.fetchall()
     cur.close()
     return (rv[0] if rv else None) if one else rv
 
 
-def get_entry(table, field, value):
-    """Get the first entry of the table with its field equals to value"""
+def get_entry(table, field, value, poll=None):
+    """Get the first entry of the table with its field equals to value, from the shard of a poll"""
 
-    return query_read('SELECT * FROM ' + table + ' WHERE ' + field + ' = ?', [value], one=True)
+    return query_read('SELECT * FROM ' + table + ' WHERE ' + field + ' = ?', [value], one=True, poll=poll)
 
 
-def get_entries(table, field, value):
-    """Get all entries of the table with their field equals to value"""
+def get_entries(table, field, value, poll=None):
+    """Get all entries of the table with their field equals to value, from the shard of a poll"""
 
-    return query_read('SELECT * FROM ' + table + ' WHERE ' + field + ' = ?', [value])
+    return query_read('SELECT * FROM ' + table + ' WHERE ' + field + ' = ?', [value], poll=poll)
 
 
-def insert_poll(title, message, choices, end_date, owner):
+EXPORT_QUERY = """
+    SELECT results.poll, polls.title, polls.end_date, results.choice, choices.text, results.rank,
+           (SELECT group_concat(rank) FROM ties WHERE ties.poll = results.poll AND ties.choice = results.choice),
+           results.grade, results.ballots, """ + ", ".join('results.' + column for column in GRADE_COLUMNS) + """
+    FROM results JOIN polls ON polls.uid = results.poll JOIN choices ON choices.id = results.choice
+"""
+
+
+# Voters whose previous grades are read by each query of an import, under the 999 parameters of SQLite
+IMPORT_VOTERS_BY_QUERY = 500
+
+
+def update_tallies(db, tallies):
     """
-    Create a poll.
+    Add the differences of the numbers of votes to the tallies, within the transaction of the ballots
 
-    :return: uid or None if the insertion failed
+    :param tallies: Difference of each tally {(poll, choice_id, grade): delta,}
     """
+    db.executemany("INSERT OR IGNORE INTO tallies (poll, choice, grade, count) VALUES (?, ?, ?, 0)", [tally for tally, delta in tallies.items() if delta > 0])
+    db.executemany("UPDATE tallies SET count = count + ? WHERE poll = ? AND choice = ? AND grade = ?", [(delta,) + tally for tally, delta in tallies.items() if delta])
 
-    uid = str(uuid4())
 
-    db = get_db()
+class SQLiteStorage(Storage):
+    """Storage in the SQLite databases of the shards, each poll lives in the database of its shard"""
+
+    def init(self):
+        with app.app_context():
+            for db in get_dbs():
+                if query_read("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'polls'", one=True, db=db) is None:
+                    with app.open_resource('schema.sql', mode='r') as f:
+                        db.cursor().executescript(f.read())
+                else:
+                    current = query_read('PRAGMA user_version', one=True, db=db)[0]
+                    for version in range(current, len(MIGRATIONS)):
+                        migrate(db, version)
+
+                db.execute('PRAGMA user_version = %d' % len(MIGRATIONS))
+                db.commit()
+
+    def insert_poll(self, poll, choices):
+        db = get_db(poll['uid'])
+        with db:
+            db.execute("INSERT INTO polls (uid, title, message, end_date, owner, message_html) VALUES (?, ?, ?, ?, ?, ?)", [poll['uid'], poll['title'], poll['message'], poll['end_date'], poll['owner'], poll['message_html']])
+            db.executemany("INSERT INTO choices (poll, text, html) VALUES (?, ?, ?)", [(poll['uid'], text, html) for text, html in choices])
+
+    def read_poll(self, poll):
+        rows = query_read('SELECT polls.*, choices.id AS choice_id, choices.text AS choice_text, choices.html AS choice_html FROM polls LEFT JOIN choices ON choices.poll = polls.uid WHERE polls.uid = ? ORDER BY choices.id', [poll], poll=poll)
+
+        if not rows:
+            return None
+
+        read = dict(rows[0])
+        del read['choice_id'], read['choice_text'], read['choice_html']
+
+        read['choices'] = []
+        for row in rows:
+            if row['choice_id'] is not None:
+                read['choices'].append({'id': row['choice_id'], 'poll': read['uid'], 'text': row['choice_text'], 'html': row['choice_html']})
+
+        return read
+
+    def set_end_date(self, poll, end_date):
+        with get_db(poll) as db:
+            db.execute('UPDATE polls SET end_date = ? WHERE uid = ?', [end_date, poll])
 
-    with db:
-        get_db().execute("INSERT INTO polls (uid, title, message, end_date, owner) VALUES (?, ?, ?, ?, ?)", [uid, title, message, end_date, owner])
+    def owner_polls(self, owner):
+        polls = []
+        for db in get_dbs():
+            polls += [dict(poll) for poll in query_read('SELECT * FROM polls WHERE owner = ?', [owner], db=db)]
+        return polls
 
-        choice_db = []
-        for choice in choices:
-            choice_db.append((uid, choice))
+    def voter_polls(self, voter):
+        polls = []
+        for db in get_dbs():
+            shard_polls = [dict(poll, choices=[]) for poll in query_read('SELECT * FROM polls WHERE uid IN (SELECT poll FROM ballots WHERE voter = ?)', [voter], db=db)]
 
-        get_db().executemany("INSERT INTO choices (poll, text) VALUES (?, ?)", choice_db)
+            if not shard_polls:
+                continue
 
-        return uid
+            # Load the choices of all the polls of the shard at once
+            polls_by_uid = dict((poll['uid'], poll) for poll in shard_polls)
+            for choice in query_read('SELECT * FROM choices WHERE poll IN (SELECT poll FROM ballots WHERE voter = ?) ORDER BY id', [voter], db=db):
+                polls_by_uid[choice['poll']]['choices'].append(dict(choice))
 
-    return None
+            polls.extend(shard_polls)
+
+        return polls
+
+    def delete_poll(self, poll):
+        db = get_db(poll)
+        db.execute('DELETE FROM ballots WHERE poll = ?;', [poll])
+        db.execute('DELETE FROM tallies WHERE poll = ?;', [poll])
+        db.execute('DELETE FROM ties WHERE poll = ?;', [poll])
+        db.execute('DELETE FROM results WHERE poll = ?;', [poll])
+        db.execute('DELETE FROM choices WHERE poll = ?;', [poll])
+        db.execute('DELETE FROM polls WHERE uid = ?;', [poll])
+        db.commit()
+
+    def read_ballot(self, voter, poll):
+        return dict(query_read("SELECT choices.id, ballots.grade FROM choices JOIN ballots ON ballots.poll = ? and choices.id = ballots.choice and ballots.voter = ? ORDER BY choices.id;", [poll, voter], poll=poll))
+
+    def is_open(self, db, poll):
+        """:return: True if a poll accepts ballots: it has not ended and has no results"""
+        return query_read("SELECT 1 FROM polls WHERE uid = ? AND end_date > ? AND NOT EXISTS (SELECT 1 FROM results WHERE results.poll = polls.uid)", [poll, datetime.now()], one=True, db=db) is not None
+
+    def write_ballot(self, voter, poll, grades):
+        db = get_db(poll)
+        with db:
+            # The results cannot be stored between the check of the poll and the commit of the ballot
+            db.execute('BEGIN IMMEDIATE')
+            if not self.is_open(db, poll):
+                return False
+
+            # Previous grades of the voter, to update the tallies
+            previous = dict(query_read("SELECT choice, grade FROM ballots WHERE voter = ? AND poll = ?", [voter, poll], poll=poll))
+
+            ballot = []
+            removed = []
+            added = []
+            for choice, grade in grades.iteritems():
+                ballot.append((voter, poll, choice, grade))
+                if previous.get(choice) != grade:
+                    if choice in previous:
+                        removed.append((poll, choice, previous[choice]))
+                    added.append((poll, choice, grade))
+
+            db.executemany("INSERT OR REPLACE INTO ballots (voter, poll, choice, grade) VALUES (?, ?, ?, ?)", ballot)
+
+            db.executemany("UPDATE tallies SET count = count - 1 WHERE poll = ? AND choice = ? AND grade = ?", removed)
+            db.executemany("INSERT OR IGNORE INTO tallies (poll, choice, grade, count) VALUES (?, ?, ?, 0)", added)
+            db.executemany("UPDATE tallies SET count = count + 1 WHERE poll = ? AND choice = ? AND grade = ?", added)
+            return True
+
+    def write_ballot_batch(self, ballots):
+        by_shard = defaultdict(list)
+        for index, ballot in enumerate(ballots):
+            by_shard[shard_of(ballot[1])].append(index)
+
+        # Each shard commits its ballots or fails them alone
+        outcomes = [None] * len(ballots)
+        for shard, indexes in by_shard.items():
+            try:
+                written = self.write_shard_ballots(get_db(shard=shard), [ballots[index] for index in indexes])
+            except Exception as error:
+                written = [error] * len(indexes)
+            for index, outcome in zip(indexes, written):
+                outcomes[index] = outcome
+
+        return outcomes
+
+    def write_shard_ballots(self, db, ballots):
+        """
+        Write the ballots of polls of the same shard in a single transaction
+
+        :return: For each ballot, True if written or False if its poll has ended or has results
+        """
+        with db:
+            # The results cannot be stored between the check of the polls and the commit of their ballots
+            db.execute('BEGIN IMMEDIATE')
+            open_polls = set(poll for poll in set(ballot[1] for ballot in ballots) if self.is_open(db, poll))
+
+            # Grades of each voter, read once then updated by the following ballots of the batch
+            current = {}
+            rows = []
+            tallies = defaultdict(int)
+            for voter, poll, grades in ballots:
+                if poll not in open_polls:
+                    continue
+                if (voter, poll) not in current:
+                    current[(voter, poll)] = dict(query_read("SELECT choice, grade FROM ballots WHERE voter = ? AND poll = ?", [voter, poll], db=db))
+                previous = current[(voter, poll)]
+
+                for choice, grade in grades.iteritems():
+                    rows.append((voter, poll, choice, grade))
+                    if previous.get(choice) != grade:
+                        if choice in previous:
+                            tallies[(poll, choice, previous[choice])] -= 1
+                        tallies[(poll, choice, grade)] += 1
+                        previous[choice] = grade
+
+            db.executemany("INSERT OR REPLACE INTO ballots (voter, poll, choice, grade) VALUES (?, ?, ?, ?)", rows)
+            update_tallies(db, tallies)
+
+        return [ballot[1] in open_polls for ballot in ballots]
+
+    def write_ballots(self, poll, ballots):
+        # Last grade of each voter for each choice, the ballots of the batch replace each other
+        grades = dict(((voter, choice), grade) for voter, _, choice, grade in ballots)
+        voters = list(set(voter for voter, _ in grades))
+
+        db = get_db(poll)
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            if not self.is_open(db, poll):
+                return False
+
+            previous = {}
+            for start in range(0, len(voters), IMPORT_VOTERS_BY_QUERY):
+                chunk = voters[start:start + IMPORT_VOTERS_BY_QUERY]
+                query = "SELECT voter, choice, grade FROM ballots WHERE poll = ? AND voter IN (%s)" % ', '.join('?' * len(chunk))
+                for voter, choice, grade in db.execute(query, [poll] + chunk):
+                    previous[(voter, choice)] = grade
+
+            tallies = defaultdict(int)
+            for (voter, choice), grade in grades.iteritems():
+                if previous.get((voter, choice)) != grade:
+                    if (voter, choice) in previous:
+                        tallies[(poll, choice, previous[(voter, choice)])] -= 1
+                    tallies[(poll, choice, grade)] += 1
+
+            db.executemany("INSERT OR REPLACE INTO ballots (voter, poll, choice, grade) VALUES (?, ?, ?, ?)", ((voter, poll, choice, grade) for (voter, choice), grade in grades.iteritems()))
+            update_tallies(db, tallies)
+            return True
+
+    def voters(self, poll, after=None, limit=None):
+        voters = query_read("SELECT DISTINCT voter FROM ballots WHERE poll = ? AND voter > ? ORDER BY voter LIMIT ?;", [poll, after or '', limit if limit is not None else -1], poll=poll)
+        return [voter[0] for voter in voters]
+
+    def count_voters(self, poll, choice):
+        return query_read("SELECT COALESCE(SUM(count), 0) FROM tallies WHERE poll = ? AND choice = ?", [poll, choice], one=True, poll=poll)[0]
+
+    def read_tallies(self, poll):
+        # The rows are read from the database while they are consumed
+        return get_db(poll).execute('SELECT choice, grade, count FROM tallies WHERE poll = ?', [poll])
+
+    def ended_polls(self, since, until):
+        polls = []
+        for db in get_dbs():
+            if since is None:
+                polls += query_read('SELECT uid FROM polls WHERE end_date <= ? AND EXISTS (SELECT 1 FROM tallies WHERE tallies.poll = polls.uid) AND NOT EXISTS (SELECT 1 FROM results WHERE results.poll = polls.uid) ORDER BY end_date', [until], db=db)
+            else:
+                polls += query_read('SELECT uid FROM polls WHERE end_date > ? AND end_date <= ? AND EXISTS (SELECT 1 FROM tallies WHERE tallies.poll = polls.uid) AND NOT EXISTS (SELECT 1 FROM results WHERE results.poll = polls.uid) ORDER BY end_date', [since, until], db=db)
+        return [poll['uid'] for poll in polls]
+
+    @contextmanager
+    def transaction(self, poll):
+        # Only one process at a time reads or writes the results of a poll
+        db = get_db(poll)
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+            db.commit()
+        except:
+            db.rollback()
+            raise
+
+    def read_results(self, poll):
+        results = []
+        for result in query_read('SELECT * FROM results WHERE poll = ? ORDER BY rank, choice', [poll], poll=poll):
+            results.append({'choice': result['choice'], 'rank': result['rank'], 'ties': [], 'grade': result['grade'], 'percentages': list(bytearray(result['percentages'])), 'ballots': result['ballots'], 'votes': [result[column] for column in GRADE_COLUMNS]})
+
+        if results:
+            by_choice = dict((result['choice'], result) for result in results)
+            for choice, rank in query_read('SELECT choice, rank FROM ties WHERE poll = ? ORDER BY choice, rank', [poll], poll=poll):
+                by_choice[choice]['ties'].append(rank)
+
+        return results
+
+    def write_results(self, poll, results):
+        # The ranks of tie choices are stored apart
+        results_db = []
+        ties_db = []
+        for result in results:
+            results_db.append([poll, result['choice'], result['rank'], result['grade'], sqlite3.Binary(bytearray(result['percentages'])), result['ballots']] + list(result['votes']))
+            ties_db.extend((poll, result['choice'], rank) for rank in result['ties'])
+
+        db = get_db(poll)
+        db.executemany("INSERT INTO results (poll, choice, rank, grade, percentages, ballots, " + ", ".join(GRADE_COLUMNS) + ") VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", results_db)
+        db.executemany("INSERT INTO ties (poll, choice, rank) VALUES (?, ?, ?)", ties_db)
+
+        # Destroy the ballots
+        db.execute('DELETE FROM ballots WHERE poll = ?', [poll])
+        db.execute('DELETE FROM tallies WHERE poll = ?', [poll])
+
+    def export_results(self, poll=None):
+        if poll is None:
+            cursors = (db.execute(EXPORT_QUERY + ' ORDER BY results.poll, results.rank, results.choice') for db in get_dbs())
+        else:
+            cursors = [get_db(poll).execute(EXPORT_QUERY + ' WHERE results.poll = ? ORDER BY results.rank, results.choice', [poll])]
+
+        for cursor in cursors:
+            # The rows are read from the database while they are consumed
+            for row in cursor:
+                row = list(row)
+                ties = row[6]
+                yield {'poll': row[0], 'title': row[1], 'end_date': row[2], 'choice': row[3], 'text': row[4], 'rank': row[5],
+                       'ties': sorted(int(rank) for rank in ties.split(',')) if ties else [], 'grade': row[7], 'ballots': row[8], 'votes': row[9:]}
+
+
+STORAGES = {'sqlite': SQLiteStorage(), 'memory': MemoryStorage()}
+
+
+def get_storage():
+    """:return: The storage selected by STORAGE"""
+    return STORAGES[app.config['STORAGE']]
+
+
+def insert_poll(title, message, choices, end_date, owner):
+    """
+    Create a poll.
+
+    :return: uid or None if the insertion failed
+    """
+
+    uid = str(uuid4())
+
+    get_storage().insert_poll({'uid': uid, 'title': title, 'message': message, 'message_html': md_message(message), 'end_date': end_date, 'owner': owner},
+                              [(choice, md_choice(choice)) for choice in choices])
+
+    return uid
 
 
 def add_update_ballot(voter, poll, choices):
@@ -106,218 +634,787 @@ def add_update_ballot(voter, poll, choices):
     :param poll: UID of the poll
     :param choices: Choices associated with their grade
     :type choices: {choice_id: grade,}
-    :return: True if the operation is a success
+    :return: True if the operation is a success, False if the ballot is invalid or its poll is closed
+    """
+
+    # The poll may be cached, the storage checks again that it is open when writing the ballot
+    poll = get_poll(poll)
+    if poll is None or poll['closed'] is True or set(choices) != set(choice['id'] for choice in poll['choices']):
+        return False
+
+    if any(grade not in range(len(GRADES)) for grade in choices.values()):
+        return False
+
+    if app.config['GROUP_COMMIT_INTERVAL']:
+        written = get_ballot_writer().write(voter, poll['uid'], choices)
+    else:
+        written = get_storage().write_ballot(voter, poll['uid'], choices)
+
+    if not written:
+        # The cached poll was still open
+        invalidate_poll(poll['uid'])
+    return written
+
+
+def import_ballots(poll, ballots, batch_size=None, progress=None):
     """
+    Add or replace many ballots of a poll at once, the invalid ones are skipped
+
+    :param poll: UID of the poll
+    :param ballots: Voters associated with their choices and grades, a voter appearing twice keeps the last one
+    :type ballots: iterable of (voter, {choice_id: grade,})
+    :param batch_size: Number of ballots written by each transaction, IMPORT_BATCH_SIZE by default
+    :param progress: Function called with the numbers of imported and of rejected ballots after each transaction
+    :return: Numbers of imported and of rejected ballots or None if the poll does not exist or is closed, the import
+             stops before the first batch written after the end of the poll
+    """
+    batch_size = batch_size or app.config['IMPORT_BATCH_SIZE']
+
+    poll = get_poll(poll)
+    if poll is None or poll['closed'] is True:
+        return None
+
+    choice_ids = frozenset(choice['id'] for choice in poll['choices'])
+    grades = frozenset(range(len(GRADES)))
+    uid = poll['uid']
 
-    db = get_db()
+    storage = get_storage()
+    imported = rejected = 0
+    batch = 0
+    rows = []
 
-    with db:
-        poll = get_poll(poll)
-        if poll is None or poll['closed'] is True or len(poll['choices']) != len(choices):
+    def write():
+        """Write the ballots of the batch with their tallies, :return: False if the poll ended meanwhile"""
+        # The storage checks the end date when writing, it may have changed since the import started
+        if not storage.write_ballots(uid, rows):
             return False
+        del rows[:]
+        return True
 
-        ballot = []
-        for choice, grade in choices.iteritems():
-            ballot.append((voter, poll['uid'], choice, grade))
+    for voter, choices in ballots:
+        if not voter or len(choices) != len(choice_ids) or not choice_ids.issuperset(choices) or not grades.issuperset(choices.itervalues()):
+            rejected += 1
+            continue
 
-        get_db().executemany("INSERT OR REPLACE INTO ballots (voter, poll, choice, grade) VALUES (?, ?, ?, ?)", ballot)
+        rows += [(voter, uid, choice, grade) for choice, grade in choices.iteritems()]
+        batch += 1
+        if batch == batch_size:
+            if not write():
+                return imported, rejected
+            imported += batch
+            batch = 0
+            if progress is not None:
+                progress(imported, rejected)
 
-    return True
+    if rows:
+        if not write():
+            return imported, rejected
+        imported += batch
+        if progress is not None:
+            progress(imported, rejected)
+
+    return imported, rejected
 
 
 def get_poll(poll):
-    """Get a poll from the database"""
-    poll = get_entry('polls', 'uid', poll)
+    """Get a poll from the cache or the storage"""
+    cached = poll_cache.get(poll)
 
-    if poll is None:
-        return None
+    if cached is None:
+        cached = get_storage().read_poll(poll)
 
-    poll = dict(poll)
+        if cached is None:
+            return None
+
+        poll_cache.set(cached['uid'], cached)
 
-    poll['choices'] = []
-    for choice in get_entries('choices', 'poll', poll['uid']):
-        poll['choices'].append(dict(choice))
-    poll['choices'].sort(key=lambda x: x['id'])
+    # Copy the cached poll so that the caller can modify it
+    poll = dict(cached)
+    poll['choices'] = [dict(choice) for choice in cached['choices']]
 
     poll['closed'] = poll['end_date'] < datetime.now()
     return poll
 
 
-def get_own_polls(owner):
-    """Get all polls owned by an user from the database"""
-    polls_db = get_entries('polls', 'owner', owner)
+def invalidate_poll(poll):
+    """Remove a poll from the caches, must be called when a poll is modified"""
+    poll_cache.pop(poll)
+    results_page_cache.pop(poll)
 
-    if polls_db is None:
-        return None
 
-    polls = []
-    for poll in polls_db:
-        poll = dict(poll)
+def set_poll_end_date(poll, end_date):
+    """Change the end date of a poll, to close it early or extend it"""
+    get_storage().set_end_date(poll, end_date)
+    invalidate_poll(poll)
+
+
+def get_own_polls(owner):
+    """Get all polls owned by an user, from all the shards"""
+    polls = get_storage().owner_polls(owner)
+    for poll in polls:
         poll['closed'] = poll['end_date'] < datetime.now()
-        polls.append(poll)
 
     return polls
 
 
 def get_participate_polls(voter):
-    """Get all polls the user has vote for from the database"""
-    ballots = get_entries('ballots', 'voter', voter)
-
-    if ballots is None:
-        return None
-
-    polls_uid = set()
-    for ballot in ballots:
-        polls_uid.add(ballot['poll'])
-        
-    polls = []
-    for poll_uid in polls_uid:
-        poll = get_poll(poll_uid)
-        if poll is not None:
-            polls.append(poll)
+    """Get all polls the user has vote for, from all the shards, with their choices"""
+    polls = get_storage().voter_polls(voter)
 
     if not polls:
         return None
 
-    return list(polls)
+    for poll in polls:
+        poll['closed'] = poll['end_date'] < datetime.now()
+
+    return polls
 
 
 def delete_poll(poll):
-    """Delete a poll from the database"""
-    get_db().execute('DELETE FROM ballots WHERE poll = ?;', [poll])
-    get_db().execute('DELETE FROM results WHERE poll = ?;', [poll])
-    get_db().execute('DELETE FROM choices WHERE poll = ?;', [poll])
-    get_db().execute('DELETE FROM polls WHERE uid = ?;', [poll])
-    get_db().commit()
+    """Delete a poll from the storage"""
+    invalidate_poll(poll)
+    get_storage().delete_poll(poll)
+
+
+def move_poll(poll, source, target):
+    """
+    Move a poll with its choices, ballots, tallies and results from a database to another.
+
+    The choices get new ids in the target database. A poll already in the target database (from an interrupted move)
+    is only deleted from the source one.
+
+    :param poll: UID of the poll
+    :param source: Connection to the database of the poll
+    :param target: Connection to the database receiving the poll
+    """
+
+    if target.execute('SELECT 1 FROM polls WHERE uid = ?', [poll]).fetchone() is None:
+        with target:
+            row = source.execute('SELECT * FROM polls WHERE uid = ?', [poll]).fetchone()
+            target.execute('INSERT INTO polls (%s) VALUES (%s)' % (', '.join(row.keys()), ', '.join('?' * len(row))), tuple(row))
+
+            choices = {}
+            for choice in source.execute('SELECT * FROM choices WHERE poll = ? ORDER BY id', [poll]).fetchall():
+                choices[choice['id']] = target.execute('INSERT INTO choices (poll, text, html) VALUES (?, ?, ?)', [poll, choice['text'], choice['html']]).lastrowid
+
+            for table in ('ballots', 'tallies', 'results', 'ties'):
+                rows = source.execute('SELECT * FROM %s WHERE poll = ?' % table, [poll])
+                columns = [column[0] for column in rows.description]
+                target.executemany('INSERT INTO %s (%s) VALUES (%s)' % (table, ', '.join(columns), ', '.join('?' * len(columns))),
+                                   (tuple(choices[value] if column == 'choice' else value for column, value in zip(columns, row)) for row in rows))
+
+    with source:
+        for table in ('ties', 'results', 'tallies', 'ballots', 'choices'):
+            source.execute('DELETE FROM %s WHERE poll = ?' % table, [poll])
+        source.execute('DELETE FROM polls WHERE uid = ?', [poll])
+
+    invalidate_poll(poll)
+
+
+def rebalance(shards):
+    """
+    Move the polls to their shard after a change of DATABASE_SHARDS, the databases must be initialized first.
+
+    :param shards: Number of shards before the change
+    :return: generator of the UIDs of the moved polls
+    """
+
+    for shard in range(max(shards, app.config['DATABASE_SHARDS'])):
+        if not os.path.exists(shard_path(shard)):
+            continue
+
+        source = get_db(shard=shard)
+        for poll, in source.execute('SELECT uid FROM polls').fetchall():
+            if shard_of(poll) != shard:
+                move_poll(poll, source, get_db(shard=shard_of(poll)))
+                yield poll
 
 
 def get_voter_ballot(voter, poll):
-    """Get ballot from a user from the database
+    """Get ballot from a user from the storage
 
     :param voter: name of the voter
     :param poll: UID of the poll
-    :return: [(choices.id, ballots.grade),]
+    :return: {choice_id: grade,}
     """
-    ballot = query_read("SELECT choices.id, ballots.grade FROM choices JOIN ballots ON ballots.poll = ? and choices.id = ballots.choice and ballots.voter = ? ORDER BY choices.id;", [poll, voter])
+    ballot = get_storage().read_ballot(voter, poll)
 
     if not ballot:
         return None
 
-    return dict(ballot)
+    return ballot
 
-def get_ballot_voters(poll):
+def get_ballot_voters(poll, after=None, limit=None):
     """
-    Return the list of all the voters from a poll
+    Return the voters from a poll, by name
+
     :param poll: UID of the poll
+    :param after: Only return the voters after this name, the last one of the previous page
+    :param limit: Maximum number of voters returned, None for all
     :return: [str(voter),]
     """
-    voters = query_read("SELECT voter FROM ballots WHERE poll = ? ORDER BY voter;", [poll])
+    voters = get_storage().voters(poll, after, limit)
 
     if not voters:
         return None
 
-    return [voter[0] for voter in voters]
+    return voters
 
-def choice_compute(choice):
-    if len(choice['votes']) % 2 == 0:
-        middle_point = len(choice['votes']) / 2
+
+def count_voters(poll):
+    """
+    Count the voters of an open poll from its tallies: each voter grades every choice, so the tallies of any choice
+    add up to the number of voters
+
+    :param poll: Poll from get_poll function
+    """
+    if not poll['choices']:
+        return 0
+
+    return get_storage().count_voters(poll['uid'], poll['choices'][0]['id'])
+
+def middle_point(count):
+    """
+    :return: Index of the middle point of a sorted list of count votes
+    """
+    if count % 2 == 0:
+        middle_point = count // 2
     else:
-        middle_point = (len(choice['votes']) + 1) / 2
-    choice['median'] = choice['votes'][middle_point]
-    choice['better'] = len([grade for grade in choice['votes'] if grade > choice['median']])
-    choice['worse'] = len([grade for grade in choice['votes'] if grade < choice['median']])
+        middle_point = (count + 1) // 2
 
+    # A single vote is its own middle point
+    return min(middle_point, count - 1)
 
-def choice_wheight_fct(ballots_count):
+
+def vote_at(votes, index):
     """
-    :return: A function to attribute weight to choice with a range adapted to the number of ballots.
+    :param votes: Number of votes for each grade
+    :param index: Position of a vote in the sorted list of votes
+    :return: The grade of the vote at the given position
     """
-    magnitude_order = math.pow(10, int(math.log10(ballots_count) + 1))
+    for grade, count in enumerate(votes):
+        if index < count:
+            return grade
+        index -= count
+
+    raise IndexError("vote index out of range")
 
-    def choice_weight(choice):
-        """
-        :return: A weight to a choice that allow to rank it.
-        """
-        return choice[1]['median'] * 10 * magnitude_order + ((5 * magnitude_order + choice[1]['better']) if choice[1]['better'] > choice[1]['worse'] else (magnitude_order - choice[1]['worse']))
 
-    return choice_weight
+def choice_compute(choice):
+    """Compute the median, the number of better and worse votes of a choice from its votes count"""
+    votes = choice['votes']
+    choice['median'] = vote_at(votes, middle_point(sum(votes)))
+    choice['better'] = sum(votes[choice['median'] + 1:])
+    choice['worse'] = sum(votes[:choice['median']])
 
 
 def decimate_middle_point(votes):
-    """Remove the middle point value of a list"""
-    if len(votes) % 2 == 0:
-        middle_point = len(votes) / 2
-    else:
-        middle_point = (len(votes) + 1) / 2
+    """Remove the middle point value from the votes count"""
+    votes[vote_at(votes, middle_point(sum(votes)))] -= 1
+
+
+def majority_gauge(choice):
+    """
+    :param choice: Choice with its median, better and worse votes computed
+    :return: A key ordering choices by their median then by their majority gauge
+    """
+    if choice['better'] > choice['worse']:
+        return (choice['median'], 1, choice['better'])
+    return (choice['median'], 0, -choice['worse'])
+
+
+def gauge_run(votes):
+    """
+    :param votes: Number of votes for each grade
+    :return: The majority gauge of the votes and the number of middle point removals it lasts, or (None, 0) when no
+             vote remains. The removals take the votes of the median grade, so the gauge lasts as long as the middle
+             point stays in that grade.
+    """
+    total = sum(votes)
+    if total == 0:
+        return None, 0
+
+    choice = {'votes': votes}
+    choice_compute(choice)
+    worse, count = choice['worse'], votes[choice['median']]
+
+    def keeps_median(removals):
+        remaining = total - removals
+        return remaining > 0 and worse <= middle_point(remaining) < worse + count - removals
+
+    # The middle point leaves the median grade after the first removal which does not keep it, a binary search on
+    # the removals finds it as both bounds move monotonically
+    low, high = 1, count
+    if keeps_median(1):
+        low = 2
+        while low < high:
+            middle = (low + high) // 2
+            if keeps_median(middle):
+                low = middle + 1
+            else:
+                high = middle
+
+    return majority_gauge(choice), low
+
+
+# Maximum number of runs of majority gauges kept by each majority value, the next ones are computed again by each
+# comparison which needs them
+MAJORITY_RUNS_CACHE = 4096
+
+
+class MajorityValue(object):
+    """
+    Majority value of a choice: the sequence of majority gauges obtained by removing the middle point vote one by one.
+
+    The sequence is computed lazily, only as far as needed to order two choices, by runs of identical gauges. Its
+    first runs are kept for the next comparisons, up to MAJORITY_RUNS_CACHE, so that the memory does not grow with
+    the number of ballots.
+    """
 
-    del votes[middle_point]
+    __slots__ = ('counts', 'votes', 'cache')
+
+    def __init__(self, votes):
+        self.counts = tuple(votes)
+        # Votes left after the cached runs
+        self.votes = list(votes)
+        self.cache = []
+
+    def runs(self):
+        """:return: generator of the runs of the sequence (gauge, length), ending with (None, 0)"""
+        index = 0
+        # Votes left by this walk once beyond the cache
+        votes = None
+        while True:
+            if index < len(self.cache):
+                run = self.cache[index]
+            elif index < MAJORITY_RUNS_CACHE:
+                run = gauge_run(self.votes)
+                self.cache.append(run)
+                if run[0] is not None:
+                    self.votes[run[0][0]] -= run[1]
+            else:
+                if votes is None:
+                    votes = list(self.votes)
+                run = gauge_run(votes)
+                if run[0] is not None:
+                    votes[run[0][0]] -= run[1]
+
+            index += 1
+            yield run
+            if run[0] is None:
+                return
+
+    def __eq__(self, other):
+        # Removing the middle points one by one enumerates every vote, so only identical votes give the same sequence
+        return self.counts == other.counts
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __lt__(self, other):
+        if self == other:
+            return False
 
+        runs, other_runs = self.runs(), other.runs()
+        (gauge, length), (other_gauge, other_length) = next(runs), next(other_runs)
+        while True:
+            if gauge != other_gauge:
+                return other_gauge is not None and (gauge is None or gauge < other_gauge)
+            if gauge is None:
+                return False
 
-def list_equals_values(lst):
-    return not lst or lst.count(lst[0]) == len(lst)
+            removals = min(length, other_length)
+            length -= removals
+            other_length -= removals
+            if length == 0:
+                gauge, length = next(runs)
+            if other_length == 0:
+                other_gauge, other_length = next(other_runs)
 
 
-def rank_choices(choices, ballots_count):
+def rank_choices(choices):
     """
+    :param choices: For each choice, its votes count
     :return: For each choice, its ranks (tie choices have a list of ranks)
     """
 
-    choice_weight = choice_wheight_fct(ballots_count)
+    values = dict((choice, MajorityValue(value['votes'])) for choice, value in choices.items())
+    ordered = sorted(values, key=values.get, reverse=True)
+
     ranks = {}
+    start = 0
+    while start < len(ordered):
+        # Find the choices with exactly the same votes
+        end = start + 1
+        while end < len(ordered) and values[ordered[end]] == values[ordered[start]]:
+            end += 1
+
+        # A lonely choice is always a tie with itself
+        if end - start > 1 or len(ordered) == 1:
+            for choice in ordered[start:end]:
+                ranks[choice] = list(range(start + 1, end + 1))
+        else:
+            ranks[ordered[start]] = start + 1
+
+        start = end
 
-    # Transform the choices dictionnary to a list to be able to sort it
-    choices = copy.copy(choices.items())
+    return ranks
 
-    # At first all the results are stated as ties
-    ties = [[choices, list(range(1, len(choices) + 1))]]
 
-    # Until all tie are breaks
-    while len(ties) > 0:
-        # Pop the last tie of the list and try to break the ties
-        group = ties.pop()
-        choices = group[0]
+def grade_name(choice):
+    """
+    :return: The grade of a computed choice (eg. Excellent or Good+ or Acceptable- or ...)
+    """
+    return GRADES[choice['median']] + ("+" if choice['better'] > choice['worse'] else "-")
 
-        # If all choices in a tie group have the same votes, give them the same ranks
-        if list_equals_values([choice[1]['votes'] for choice in choices]):
-            for choice in group[0]:
-                ranks[choice[0]] = group[1]
-            continue
 
-        # Sort the element of the tie group
-        choices.sort(key=choice_weight, reverse=True)
+def compute_results(votes, ballots_count):
+    """
+    Compute the results of a poll from the votes count of its choices.
 
-        group_ranks = {}
-        for i in range(len(choices)):
-            group_ranks[choices[i][0]] = i + group[1][0]
+    :param votes: For each choice, the number of votes for each grade
+    :type votes: {choice_id: [count,]}
+    :param ballots_count: Number of ballots cast
+    :return: {choice_id: {'rank': rank, 'grade': grade, 'percentages': [percentage,], 'ballots': ballots_count}}
+    """
 
-        # Detect remaining ties and store them by groups
-        group_ties = [] # Associate the choice to their possibles ranks
-        for i in range(len(choices) -1):
-            if choice_weight(choices[i]) == choice_weight(choices[i + 1]):
-                found = False
-                for tie in group_ties:
-                    if choices[i] in tie[0]:
-                        tie[0].append(choices[i + 1])
-                        tie[1].append(group_ranks[choices[i + 1][0]])
-                        found = True
-                if not found:
-                    group_ties.append([[choices[i], choices[i + 1]], [group_ranks[choices[i][0]], group_ranks[choices[i + 1][0]]]])
+    choices = {}
+    results = {}
+    for choice, counts in votes.items():
+        choices[choice] = {'votes': list(counts)}
+        results[choice] = {'ballots': ballots_count}
 
+        # Store the count in percentage for display purposes
+        results[choice]['percentages'] = [100 * count // ballots_count for count in counts]
 
-        # Store the ranks
-        for i in range(len(choices)):
-            ranks[choices[i][0]] = i + group[1][0]
+    # Compute the median, the number of better and worse vote and apply the grade
+    for choice in choices:
+        choice_compute(choices[choice])
+        results[choice]['grade'] = grade_name(choices[choice])
 
-        # Add new ties group to the list of ties
-        ties.extend(group_ties)
+    # Sort the vote to etablish the ranks
+    with Phase('rank'):
+        ranks = rank_choices(choices)
+    for choice in results:
+        results[choice]['rank'] = ranks[choice]
 
-        # Decimate values from ties chocies
-        for group in group_ties:
-            for choice in group[0]:
-                decimate_middle_point(choice[1]['votes'])
-                choice_compute(choice[1])
+    return results
+
+
+def compute_results_numpy(choices, votes, ballots_count):
+    """
+    Compute the results of a poll from the votes count of its choices, all choices at once.
+
+    :param choices: Identifiers of the choices
+    :param votes: Matrix of the number of votes for each grade (columns) of each choice (rows)
+    :param ballots_count: Number of ballots cast
+    :return: Same as compute_results
+    """
+
+    cumulated = votes.cumsum(axis=1)
+    totals = cumulated[:, -1]
+    rows = numpy.arange(len(choices))
+
+    # Middle point of each choice (see middle_point)
+    middle_points = numpy.minimum(numpy.where(totals % 2 == 0, totals // 2, (totals + 1) // 2), totals - 1)
+
+    # The median is the first grade which cumulated votes go beyond the middle point
+    medians = (cumulated <= middle_points[:, None]).sum(axis=1)
+    better = totals - cumulated[rows, medians]
+    worse = cumulated[rows, medians] - votes[rows, medians]
+    percentages = 100 * votes // ballots_count
+
+    results = {}
+    for choice, median, choice_better, choice_worse, choice_percentages in zip(choices, medians.tolist(), better.tolist(), worse.tolist(), percentages.tolist()):
+        results[choice] = {'grade': grade_name({'median': median, 'better': choice_better, 'worse': choice_worse}), 'percentages': choice_percentages, 'ballots': ballots_count}
+
+    # Sort the vote to etablish the ranks
+    with Phase('rank'):
+        ranks = rank_choices(dict((choice, {'votes': choice_votes}) for choice, choice_votes in zip(choices, votes.tolist())))
+    for choice in results:
+        results[choice]['rank'] = ranks[choice]
+
+    return results
+
+
+def count_votes(poll):
+    """
+    Read the votes count of a poll from its tallies.
+
+    :param poll: Poll from get_poll function
+    :return: For each choice, the number of votes for each grade {choice_id: [count,]}
+    """
+    votes = {}
+    for choice in poll['choices']:
+        votes[choice['id']] = [0] * len(GRADES)
+
+    with Phase('fetch'):
+        for choice, grade, count in get_storage().read_tallies(poll['uid']):
+            votes[choice][grade] = count
+
+    return votes
 
-    return ranks
+
+def tally_results(poll, votes=None):
+    """
+    Compute the results of a poll from its tallies, without storing them.
+
+    :param poll: Poll from get_poll function
+    :param votes: Votes count of the poll if already read with count_votes
+    :return: Same as compute_results or None if no ballot was cast
+    """
+    if votes is None:
+        votes = count_votes(poll)
+    votes_count = sum(sum(counts) for counts in votes.values())
+
+    # If no ballots provide, no results
+    if votes_count == 0:
+        return None
+
+    # Number of ballots cast, each one has a vote for each choice
+    ballots_count = votes_count // len(poll['choices'])
+
+    with Phase('tally'):
+        if numpy is not None and ballots_count >= app.config['NUMPY_TALLY_THRESHOLD']:
+            choices = sorted(votes)
+            return compute_results_numpy(choices, numpy.array([votes[choice] for choice in choices]), ballots_count)
+
+        return compute_results(votes, ballots_count)
+
+
+def get_live_results(poll):
+    """
+    Get the results of an open poll as if it was closed now. Nothing is stored.
+
+    :param poll: Poll from get_poll function
+    """
+
+    assert poll is not None, "Invalid poll: None"
+
+    if poll['closed']:
+        return get_results(poll)
+
+    return tally_results(poll)
+
+
+def compute_and_store_results(poll):
+    """
+    Compute the results of a poll, store them and destroy the ballots.
+
+    :param poll: Poll from get_poll function
+    :return: Same as compute_results or None if no ballot was cast
+    """
+
+    votes = count_votes(poll)
+    results = tally_results(poll, votes)
+
+    # If no ballots provide, no results
+    if results is None:
+        return None
+
+    with Phase('store'):
+        stored = []
+        for choice, result in results.items():
+            ranks = result['rank'] if isinstance(result['rank'], list) else [result['rank']]
+            stored.append({'choice': choice, 'rank': ranks[0], 'ties': ranks if isinstance(result['rank'], list) else [], 'grade': result['grade'], 'percentages': result['percentages'], 'ballots': result['ballots'], 'votes': votes[choice]})
+
+        get_storage().write_results(poll['uid'], stored)
+
+    return results
+
+
+def close_polls(since=None, until=None):
+    """
+    Compute the results of the polls closed in a period, so that no request has to.
+
+    :param since: Only close the polls which ended after this date, None to close all the pending polls
+    :param until: Only close the polls which ended before this date, None for now
+    :return: UIDs of the closed polls, the polls whose results fail are logged and skipped
+    """
+
+    if until is None:
+        until = datetime.now()
+
+    polls = get_storage().ended_polls(since, until)
+
+    closed = []
+    for uid in polls:
+        try:
+            poll = get_poll(uid)
+            if poll is not None and poll['closed'] and get_results(poll) is not None:
+                closed.append(poll['uid'])
+        except Exception:
+            app.logger.exception('Failed to compute the results of poll %s', uid)
+
+    return closed
+
+
+class Closer(threading.Thread):
+    """
+    Background thread computing the results of the polls when they end.
+
+    Each check closes all the ended polls without results: the ones which ended while no closer was running, the ones
+    whose end date was moved to the past and the ones which failed at a previous check.
+
+    :param interval: Number of seconds between two checks of the ended polls
+    """
+
+    def __init__(self, interval):
+        super(Closer, self).__init__(name='mjpoll-closer')
+        self.daemon = True
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                with app.app_context():
+                    try:
+                        closed = close_polls()
+                    finally:
+                        close_pool()
+                for poll in closed:
+                    app.logger.info('Results computed for poll %s', poll)
+            except Exception:
+                app.logger.exception('Failed to compute the results of the ended polls')
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        """Stop the thread after the current check"""
+        self.stopped.set()
+
+
+@app.before_first_request
+def start_closer():
+    """Start a background closer in the application process when enabled"""
+    if app.config['CLOSER_INTERVAL']:
+        Closer(app.config['CLOSER_INTERVAL']).start()
+
+
+class PendingBallot(object):
+    """Ballot waiting in the queue of a BallotWriter"""
+
+    __slots__ = ('voter', 'poll', 'choices', 'done', 'written', 'error')
+
+    def __init__(self, voter, poll, choices):
+        self.voter = voter
+        self.poll = poll
+        self.choices = choices
+        self.done = threading.Event()
+        self.written = False
+        self.error = None
+
+
+class BallotWriter(threading.Thread):
+    """
+    Background thread writing the ballots cast by the threads of the process in groups: the ballots queued during an
+    interval are committed by a single transaction of each shard, and their threads wait for it.
+
+    :param interval: Number of seconds between the first ballot of a group and its commit
+    :param batch_size: Maximum number of ballots of a group
+    """
+
+    def __init__(self, interval, batch_size):
+        super(BallotWriter, self).__init__(name='mjpoll-ballot-writer')
+        self.daemon = True
+        self.interval = interval
+        self.batch_size = batch_size
+        self.queue = Queue.Queue()
+        self.pid = os.getpid()
+
+    def write(self, voter, poll, choices):
+        """
+        Queue a ballot and wait until it is committed
+
+        :return: True if the ballot was written, False if its poll closed in the meantime
+        """
+        pending = PendingBallot(voter, poll, choices)
+        self.queue.put(pending)
+        pending.done.wait()
+
+        if pending.error is not None:
+            raise pending.error
+        return pending.written
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            if batch[0] is None:
+                break
+
+            # Let the ballots of the other requests join the group
+            time.sleep(self.interval)
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(self.queue.get_nowait())
+            except Queue.Empty:
+                pass
+
+            stop = None in batch
+            self.flush([pending for pending in batch if pending is not None])
+            if stop:
+                break
+
+        close_pool()
+
+    def flush(self, batch):
+        try:
+            with app.app_context():
+                # The storage checks that the polls are still open within the transactions writing their ballots
+                storage = get_storage()
+                outcomes = storage.write_ballot_batch([(pending.voter, pending.poll, pending.choices) for pending in batch])
+
+                # The ballots of a failed shard are written again one by one, so that a bad ballot only fails itself
+                for pending, outcome in zip(batch, outcomes):
+                    if isinstance(outcome, Exception):
+                        try:
+                            outcome = storage.write_ballot(pending.voter, pending.poll, pending.choices)
+                        except Exception as error:
+                            app.logger.exception('Failed to write the ballot of %s in poll %s', pending.voter, pending.poll)
+                            pending.error = error
+                            continue
+                    pending.written = outcome
+        except Exception as error:
+            app.logger.exception('Failed to write %d ballots', len(batch))
+            for pending in batch:
+                if pending.error is None:
+                    pending.error = error
+        finally:
+            for pending in batch:
+                pending.done.set()
+
+    def stop(self):
+        """Stop the thread once the queued ballots are written"""
+        self.queue.put(None)
+
+
+# Writer of the ballots of the process when GROUP_COMMIT_INTERVAL is set
+ballot_writer = None
+ballot_writer_lock = threading.Lock()
+
+
+def get_ballot_writer():
+    """:return: The ballot writer of the process, started on first use"""
+    global ballot_writer
+
+    with ballot_writer_lock:
+        # A forked process must not share the thread of its parent
+        if ballot_writer is None or ballot_writer.pid != os.getpid():
+            ballot_writer = BallotWriter(app.config['GROUP_COMMIT_INTERVAL'] / 1000.0, app.config['GROUP_COMMIT_BATCH_SIZE'])
+            ballot_writer.start()
+
+    return ballot_writer
+
+
+def stop_ballot_writer():
+    """Write the queued ballots and stop the ballot writer of the process"""
+    global ballot_writer
+
+    with ballot_writer_lock:
+        if ballot_writer is not None:
+            ballot_writer.stop()
+            ballot_writer.join()
+            ballot_writer = None
 
 
 def get_results(poll):
@@ -334,91 +1431,57 @@ def get_results(poll):
     if not poll['closed']:
         return None
 
-    results = {}
-
-    # Get cached results
-    results_db = get_entries('results', 'poll', poll['uid'])
+    storage = get_storage()
+    stored = storage.read_results(poll['uid'])
 
     # If no cache, compute the results and store them
-    if len(results_db) == 0:
-        ballots = get_entries('ballots', 'poll', poll['uid'])
+    if not stored:
+        # Only one thread of the process and one process at a time computes the results of a poll
+        with results_locks[hash(poll['uid']) % len(results_locks)]:
+            with storage.transaction(poll['uid']):
+                # The results may have been stored while waiting for the lock
+                stored = storage.read_results(poll['uid'])
+                if not stored:
+                    return compute_and_store_results(poll)
 
-        # If no ballots provide, no results
-        if len(ballots) == 0:
-            return None
+    results = {}
+    for result in stored:
+        results[result['choice']] = {'rank': result['ties'] or result['rank'], 'grade': result['grade'], 'percentages': result['percentages'], 'ballots': result['ballots']}
 
-        # Number of ballots cast
-        ballots_count = len(ballots) / len(poll['choices'])
+    return results
 
-        # Build data structures
-        choices = {}
-        results = {}
-        for choice in poll['choices']:
-            choices[choice['id']] = {'votes': [0] * 7}
-            results[choice['id']] = {'ballots': ballots_count}
 
-        # Count the number of vote for each grade for each choice
-        for ballot in ballots:
-            choices[ballot['choice']]['votes'][ballot['grade']] += 1
+# Fields of the exported results, one row for each choice of each poll
+EXPORT_FIELDS = ['poll', 'title', 'end_date', 'choice', 'text', 'rank', 'ties', 'grade', 'ballots'] + GRADE_COLUMNS
 
-        # Store the count in percentage for display purposes
-        for choice in choices:
-            results[choice]['percentages'] = []
-            for vote in choices[choice]['votes']:
-                results[choice]['percentages'].append(100 * vote / ballots_count)
-
-        # Transfrom the number of vote to a list of votes
-        for _, choice in choices.items():
-            votes = []
-            for i in range(len(choice['votes'])):
-                votes.extend([i] * choice['votes'][i])
-            choice['votes'] = votes
-
-        # Compute the median, the number of better and worse vote.
-        for _, choice in choices.items():
-            choice_compute(choice)
-
-        # Apply the grade for each choice
-        for choice in choices:
-            if choices[choice]['median'] == 0:
-                results[choice]['grade'] = "To reject"
-            elif choices[choice]['median'] == 1:
-                results[choice]['grade'] = "Poor"
-            elif choices[choice]['median'] == 2:
-                results[choice]['grade'] = "Acceptable"
-            elif choices[choice]['median'] == 3:
-                results[choice]['grade'] = "Fair"
-            elif choices[choice]['median'] == 4:
-                results[choice]['grade'] = "Good"
-            elif choices[choice]['median'] == 5:
-                results[choice]['grade'] = "Very Good"
-            elif choices[choice]['median'] == 6:
-                results[choice]['grade'] = "Excellent"
-
-            if choices[choice]['better'] > choices[choice]['worse']:
-                results[choice]['grade'] += "+"
-            else:
-                results[choice]['grade'] += "-"
 
-        # Sort the vote to etablish the ranks
-        ranks = rank_choices(choices, ballots_count)
-        for choice in results:
-            results[choice]['rank'] = ranks[choice]
+def export_results(polls=None):
+    """
+    Read the results of closed polls one row at a time, the pending results are computed first.
 
+    :param polls: UIDs of the polls, None for all the closed polls shard by shard. Unknown and open polls are skipped
+    :return: Results of each choice by poll then by rank, ties holds the ranks shared by a tied choice (empty otherwise)
+    :rtype: generator of {field: value,}
+    """
 
-        # Store the results
-        results_db = []
-        for choice, result in results.items():
-            results_db.append((poll['uid'], choice, ";".join([str(rank) for rank in result['rank']]) if isinstance(result['rank'], list) else str(result['rank']), result['grade'], ";".join([str(percentage) for percentage in result['percentages']]), result['ballots']))
+    if polls is None:
+        close_polls()
+        rows = get_storage().export_results()
+    else:
+        rows = (row for poll in polls for row in export_poll_results(poll))
 
-        get_db().executemany("INSERT INTO results (poll, choice, rank, grade, percentages, ballots) VALUES (?, ?, ?, ?, ?, ?)", results_db)
+    for row in rows:
+        row.update(zip(GRADE_COLUMNS, row.pop('votes')))
+        yield dict((field, row[field]) for field in EXPORT_FIELDS)
 
-        # Destroy the ballots
-        get_db().execute('DELETE FROM ballots WHERE poll = ?', [poll['uid']])
 
-    else:
-        for result in results_db:
-            results[result['choice']] = {'rank' : int(result['rank']) if ';' not in result['rank'] else [int(vote) for vote in result['rank'].split(';')], 'grade': result['grade'], 'percentages': [int(percentage) for percentage in result['percentages'].split(';')], 'ballots': result['ballots']}
+def export_poll_results(poll):
+    """:return: The stored results of a closed poll, computed if needed"""
 
-    return results
+    poll = get_poll(poll)
+    if poll is None or not poll['closed']:
+        return []
+
+    get_results(poll)
 
+    return get_storage().export_results(poll['uid'])
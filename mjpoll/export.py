@@ -0,0 +1,103 @@
+# coding: utf-8
+"""
+Write the results of polls as CSV, JSON or JSON lines.
+
+The writers turn the rows of export_results into chunks of text as they come, so that an export is never held in
+memory as a whole.
+"""
+
+import csv
+import json
+from datetime import datetime
+
+from mjpoll.data import EXPORT_FIELDS
+
+# Number of rows written in each chunk
+CHUNK_ROWS = 256
+
+MIMETYPES = {'csv': 'text/csv', 'json': 'application/json', 'jsonl': 'application/x-ndjson'}
+
+
+def json_value(value):
+    """Convert the values json does not know"""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(repr(value) + ' is not JSON serializable')
+
+
+def csv_value(value):
+    """:return: The value as an utf-8 cell"""
+    if value is None:
+        return ''
+    if isinstance(value, list):
+        return ';'.join(str(item) for item in value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def chunks(lines):
+    """Group the lines by CHUNK_ROWS"""
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) == CHUNK_ROWS:
+            yield ''.join(chunk)
+            chunk = []
+    if chunk:
+        yield ''.join(chunk)
+
+
+class LastLine(object):
+    """File keeping only the last line written, for the csv writer"""
+
+    line = ''
+
+    def write(self, line):
+        self.line = line
+
+
+def csv_lines(rows):
+    output = LastLine()
+    writer = csv.writer(output)
+
+    writer.writerow(EXPORT_FIELDS)
+    yield output.line
+
+    for row in rows:
+        writer.writerow([csv_value(row[field]) for field in EXPORT_FIELDS])
+        yield output.line
+
+
+def json_lines(rows):
+    yield '['
+    separator = '\n'
+    for row in rows:
+        yield separator + json.dumps(row, default=json_value, sort_keys=True)
+        separator = ',\n'
+    yield '\n]\n'
+
+
+def jsonl_lines(rows):
+    for row in rows:
+        yield json.dumps(row, default=json_value, sort_keys=True) + '\n'
+
+
+def write_csv(rows):
+    """:return: Chunks of a CSV file with a header row, the ties are separated by semicolons"""
+    return chunks(csv_lines(rows))
+
+
+def write_json(rows):
+    """:return: Chunks of a JSON array of the rows"""
+    return chunks(json_lines(rows))
+
+
+def write_jsonl(rows):
+    """:return: Chunks of a JSON lines file, a row by line"""
+    return chunks(jsonl_lines(rows))
+
+
+WRITERS = {'csv': write_csv, 'json': write_json, 'jsonl': write_jsonl}
@@ -0,0 +1,62 @@
+# coding: utf-8
+"""Convert the markdown texts of the polls to safe HTML"""
+
+import threading
+
+import markdown
+from bleach.sanitizer import Cleaner
+from bleach.linkifier import Linker
+
+from mjpoll import app
+from mjpoll.cache import LRUCache
+
+# Tags legal in the messages and in the choices of the polls
+MESSAGE_TAGS = ['strong', 'em', 'a', 'ul', 'li', 'p', 'br']
+CHOICE_TAGS = ['strong', 'em', 'a']
+
+# HTML of the recently converted texts, by kind of text then by text
+markup_cache = LRUCache(app.config['MARKUP_CACHE_SIZE'])
+
+# Converters of each thread, they are not thread safe
+converters = threading.local()
+
+
+def set_target(attrs, new=False):
+    """Open the links in a new window"""
+    attrs[(None, u'target')] = u'_blank'
+    return attrs
+
+
+def get_converters():
+    """:return: The converters of the current thread, created on first use"""
+    if not hasattr(converters, 'markdown'):
+        converters.markdown = markdown.Markdown()
+        converters.cleaners = {'message': Cleaner(tags=MESSAGE_TAGS, strip=True), 'choice': Cleaner(tags=CHOICE_TAGS, strip=True)}
+        converters.linker = Linker(callbacks=[set_target])
+    return converters
+
+
+def render(kind, text):
+    """
+    Convert a markdown text to HTML and allow only the tags legal for its kind
+
+    :param kind: 'message' or 'choice'
+    """
+    html = markup_cache.get((kind, text))
+
+    if html is None:
+        local = get_converters()
+        html = local.linker.linkify(local.cleaners[kind].clean(local.markdown.reset().convert(text)))
+        markup_cache.set((kind, text), html)
+
+    return html
+
+
+def md_message(text):
+    """Convert a poll message to HTML"""
+    return render('message', text)
+
+
+def md_choice(text):
+    """Convert a poll choice to HTML"""
+    return render('choice', text)
@@ -0,0 +1,170 @@
+# coding: utf-8
+"""
+Optional instrumentation of the requests, enabled by INSTRUMENTATION.
+
+The time spent in the database and in the phases of the computation of the results is added to the responses in a
+Server-Timing header, and to totals of the process served by /metrics in the Prometheus text format.
+"""
+
+import time
+import sqlite3
+import threading
+from collections import OrderedDict, defaultdict
+
+from flask import g, request, has_app_context, abort, Response
+
+from mjpoll import app
+
+# Totals of the process by metric then by label
+totals = defaultdict(lambda: defaultdict(float))
+totals_lock = threading.Lock()
+
+METRICS = [('mjpoll_requests_total', 'endpoint', 'Number of requests'),
+           ('mjpoll_request_seconds_total', 'endpoint', 'Time spent in the requests'),
+           ('mjpoll_phase_calls_total', 'phase', 'Number of calls of each phase (db is the number of queries)'),
+           ('mjpoll_phase_seconds_total', 'phase', 'Time spent in each phase')]
+
+
+def enabled():
+    return app.config['INSTRUMENTATION']
+
+
+def add(metric, label, value):
+    """Add a value to a total of the process"""
+    with totals_lock:
+        totals[metric][label] += value
+
+
+def record(name, seconds, calls=1):
+    """Record the duration of a phase in the timings of the request and in the totals"""
+    if has_app_context():
+        timings = getattr(g, '_timings', None)
+        if timings is None:
+            timings = g._timings = OrderedDict()
+        timing = timings.setdefault(name, [0, 0.0])
+        timing[0] += calls
+        timing[1] += seconds
+
+    add('mjpoll_phase_calls_total', name, calls)
+    add('mjpoll_phase_seconds_total', name, seconds)
+
+
+class Phase(object):
+    """
+    Time a block of code when the instrumentation is enabled:
+
+    >>> with Phase('tally'):
+    ...     pass
+    """
+
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        if enabled():
+            self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        if self.start is not None:
+            record(self.name, time.time() - self.start)
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor recording its queries and the time spent to run them and to fetch their rows as the db phase"""
+
+    def timed(self, method, calls, *args):
+        start = time.time()
+        try:
+            return method(self, *args)
+        finally:
+            record('db', time.time() - start, calls)
+
+    def execute(self, *args):
+        return self.timed(sqlite3.Cursor.execute, 1, *args)
+
+    def executemany(self, *args):
+        return self.timed(sqlite3.Cursor.executemany, 1, *args)
+
+    def fetchone(self):
+        return self.timed(sqlite3.Cursor.fetchone, 0)
+
+    def fetchmany(self, *args):
+        return self.timed(sqlite3.Cursor.fetchmany, 0, *args)
+
+    def fetchall(self):
+        return self.timed(sqlite3.Cursor.fetchall, 0)
+
+    # Time spent to fetch the rows of the current iteration, recorded once at its end rather than for each row
+    iterating = 0.0
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        start = time.time()
+        try:
+            row = sqlite3.Cursor.next(self)
+        except StopIteration:
+            record('db', self.iterating + time.time() - start, 0)
+            self.iterating = 0.0
+            raise
+        self.iterating += time.time() - start
+        return row
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Connection running its queries with instrumented cursors"""
+
+    def cursor(self, factory=InstrumentedCursor):
+        return sqlite3.Connection.cursor(self, factory)
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+
+@app.before_request
+def start_request():
+    if enabled():
+        g._request_start = time.time()
+
+
+@app.after_request
+def add_server_timing(response):
+    start = getattr(g, '_request_start', None)
+    if start is None:
+        return response
+
+    endpoint = request.endpoint or 'none'
+    add('mjpoll_requests_total', endpoint, 1)
+    add('mjpoll_request_seconds_total', endpoint, time.time() - start)
+
+    timings = []
+    for name, (calls, seconds) in getattr(g, '_timings', {}).items():
+        timings.append('%s;desc="%d calls";dur=%.3f' % (name, calls, 1000 * seconds))
+    timings.append('total;dur=%.3f' % (1000 * (time.time() - start)))
+    response.headers['Server-Timing'] = ', '.join(timings)
+
+    return response
+
+
+@app.route('/metrics')
+def metrics():
+    """Totals of the process in the Prometheus text format"""
+    if not enabled():
+        abort(404)
+
+    lines = []
+    with totals_lock:
+        for metric, label, description in METRICS:
+            lines.append('# HELP %s %s' % (metric, description))
+            lines.append('# TYPE %s counter' % metric)
+            for value, total in sorted(totals[metric].items()):
+                lines.append('%s{%s="%s"} %s' % (metric, label, value, repr(total)))
+
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
@@ -5,17 +5,24 @@ CREATE TABLE polls (
   message   TEXT NOT NULL,                                   -- Poll description provided to the users
   end_date  TIMESTAMP NOT NULL,                              -- Date of the end of the poll (vote cannot be edited or added after this date and results are computed)
   owner     TEXT NOT NULL,                                   -- Name of the creator (used to delete poll)
+  message_html TEXT,                                         -- Message converted to HTML (NULL for polls created before it was stored)
   PRIMARY KEY(uid)
 );
 
+CREATE INDEX polls_owner ON polls (owner);
+CREATE INDEX polls_end_date ON polls (end_date);
+
 /* Contains the choices offered by a poll */
 CREATE TABLE choices (
   id    INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE,
   poll  TEXT NOT NULL,                                       -- Identifier of the parent poll
   text  TEXT NOT NULL,                                       -- Text of the poll presented to the user
+  html  TEXT,                                                -- Text converted to HTML (NULL for choices created before it was stored)
   FOREIGN KEY(poll) REFERENCES polls(uid)
 );
 
+CREATE INDEX choices_poll ON choices (poll, id);
+
 /* Contains the ballots. They are deleted once the results are computed */
 CREATE TABLE ballots (
   voter  TEXT NOT NULL,                                      -- Name of the voter (used to edit votes)
@@ -27,16 +34,45 @@ CREATE TABLE ballots (
   PRIMARY KEY (voter, poll, choice)
 );
 
+/* Covers the per poll lookups of the ballots (voters list, deletion) */
+CREATE INDEX ballots_poll ON ballots (poll, voter, choice, grade);
+
+/* Contains the number of ballots of each grade for each choice. Kept up to date while the poll is open and deleted with the ballots */
+CREATE TABLE tallies (
+  poll   TEXT NOT NULL,                                      -- Identifier of the parent poll
+  choice INTEGER NOT NULL,                                   -- Identifier of the choice
+  grade  INTEGER NOT NULL,                                   -- Grade of the choice (0 is To reject, 6 is Excellent)
+  count  INTEGER NOT NULL,                                   -- Number of ballots with this grade for the choice
+  FOREIGN KEY(poll) REFERENCES polls(uid),
+  FOREIGN KEY(choice) REFERENCES choices(id),
+  PRIMARY KEY (poll, choice, grade)
+);
+
 /* Contains results of the poll after computation. Used to be able to store data anonymously after the vote is complete. */
 CREATE TABLE  results (
   poll         TEXT NOT NULL,                                -- Identifier of the parent poll
   choice       INTEGER NOT NULL,                             -- Identifier of the choice
-  rank         TEXT NOT NULL,                                -- Rank of the choice (1 is winner), may be a semicolon list when tie appeares
+  rank         INTEGER NOT NULL,                             -- Rank of the choice (1 is winner), the first one when tie appeares (see ties)
   grade        TEXT NOT NULL,                                -- Grade of the choice (eg. Excellent or Good+ or Acceptable- or ...)
-  percentages  TEXT NOT NULL,                                -- Gross percentage of each grade (as a semicolon separeted list starting by Reject).
+  percentages  BLOB NOT NULL,                                -- Gross percentage of each grade (one byte by grade starting by Reject).
   ballots      INTEGER NOT NULL,                             -- Number of ballots cast 
+  to_reject    INTEGER,                                      -- Number of votes of each grade (NULL for results computed before they were stored)
+  poor         INTEGER,
+  acceptable   INTEGER,
+  fair         INTEGER,
+  good         INTEGER,
+  very_good    INTEGER,
+  excellent    INTEGER,
   FOREIGN KEY(poll) REFERENCES polls(uid),
   FOREIGN KEY(choice) REFERENCES choices(id),
   PRIMARY KEY (poll, choice)
 );
 
+/* Contains the ranks of the choices in a tie */
+CREATE TABLE ties (
+  poll    TEXT NOT NULL,                                     -- Identifier of the parent poll
+  choice  INTEGER NOT NULL,                                  -- Identifier of the choice
+  rank    INTEGER NOT NULL,                                  -- One of the ranks shared by the choices of the tie
+  FOREIGN KEY(poll, choice) REFERENCES results(poll, choice),
+  PRIMARY KEY (poll, choice, rank)
+);
@@ -0,0 +1,61 @@
+# coding: utf-8
+"""
+Serve MJPoll to many concurrent voters from a single process.
+
+The gevent server (optional, pip install gevent) holds each connection in a greenlet, so thousands of idle or slow
+voters cost a few kilobytes each instead of a thread. SQLite and the rendering of the templates block, they run in a
+bounded pool of SERVER_THREADS threads: a request only takes a thread while the application works on it.
+
+  $ python -m mjpoll.cli serve --async
+"""
+
+import io
+
+try:
+    from gevent.pywsgi import WSGIServer
+    from gevent.threadpool import ThreadPool
+except ImportError:
+    WSGIServer = ThreadPool = None
+
+from mjpoll import app
+
+
+class Offload(object):
+    """
+    WSGI middleware calling an application and reading its response in a pool of threads
+
+    :param application: WSGI application
+    :param pool: Pool running a function with its arguments in a thread and returning its result: pool.apply(f, args)
+    """
+
+    def __init__(self, application, pool):
+        self.application = application
+        self.pool = pool
+
+    def __call__(self, environ, start_response):
+        # The body is read by the server before the request leaves it
+        environ['wsgi.input'] = io.BytesIO(environ['wsgi.input'].read())
+        return self.pool.apply(self.run, (environ, start_response))
+
+    def run(self, environ, start_response):
+        """
+        Call the application and read its whole response, from a single thread as the contexts of Flask are bound to
+        the thread which pushed them: the streamed responses (the export) are buffered
+        """
+        response = self.application(environ, start_response)
+        try:
+            return list(response)
+        finally:
+            if hasattr(response, 'close'):
+                response.close()
+
+
+def serve_async(host, port, threads=None):
+    """Serve the application with the gevent server until interrupted"""
+    if WSGIServer is None:
+        raise RuntimeError('The asynchronous server needs gevent: pip install gevent')
+
+    pool = ThreadPool(threads or app.config['SERVER_THREADS'])
+    server = WSGIServer((host, port), Offload(app, pool))
+    app.logger.info('Serving on http://%s:%d with %d threads', host, port, pool.maxsize)
+    server.serve_forever()
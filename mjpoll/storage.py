@@ -0,0 +1,278 @@
+# coding: utf-8
+"""
+Storages of the polls, their choices, ballots, tallies and results.
+
+The functions of mjpoll.data validate, cache and compute; they read and write through the storage selected by STORAGE:
+the SQLite databases (mjpoll.data.SQLiteStorage) or the memory of the process (MemoryStorage), which keeps nothing
+across restarts and serves the tests and the benchmarks.
+"""
+
+import bisect
+import threading
+from datetime import datetime
+from collections import defaultdict
+
+
+def copy_result(result):
+    """:return: A copy of a result which shares none of its lists"""
+    return dict(result, ties=list(result['ties']), percentages=list(result['percentages']), votes=list(result['votes']))
+
+
+class Storage(object):
+    """
+    Interface of the storages.
+
+    Polls are dicts with the uid, title, message, message_html, end_date and owner keys. Choices are dicts with the id,
+    poll, text and html keys, their ids are given by the storage. Results are dicts with the choice, rank, ties (the
+    ranks shared by a tied choice, empty otherwise), grade, percentages, ballots and votes (number of votes of each
+    grade) keys.
+    """
+
+    def init(self):
+        """Create the storage or upgrade it"""
+        raise NotImplementedError
+
+    def insert_poll(self, poll, choices):
+        """
+        :param poll: Poll without its choices
+        :param choices: Text and HTML of each choice [(text, html),]
+        """
+        raise NotImplementedError
+
+    def read_poll(self, poll):
+        """:return: The poll with its choices ordered by id, or None"""
+        raise NotImplementedError
+
+    def set_end_date(self, poll, end_date):
+        raise NotImplementedError
+
+    def owner_polls(self, owner):
+        """:return: The polls of an owner, without their choices"""
+        raise NotImplementedError
+
+    def voter_polls(self, voter):
+        """:return: The polls with a ballot of a voter, with their choices"""
+        raise NotImplementedError
+
+    def delete_poll(self, poll):
+        """Delete a poll with its choices, ballots, tallies and results"""
+        raise NotImplementedError
+
+    def read_ballot(self, voter, poll):
+        """:return: The grades of a voter by choice id, empty if the voter has no ballot"""
+        raise NotImplementedError
+
+    def write_ballot(self, voter, poll, grades):
+        """
+        Add or replace the ballot of a voter and update the tallies, atomically
+
+        :return: False if the poll has ended or has results, checked within the write: nothing is written then
+        """
+        raise NotImplementedError
+
+    def write_ballot_batch(self, ballots):
+        """
+        Add or replace the ballots of several voters and update the tallies, committed at once
+
+        :param ballots: [(voter, poll, {choice_id: grade,}),] in the order they were cast
+        :return: The outcome of each ballot: True if written, False if its poll has ended or has results, or the
+                 exception which prevented its writing
+        """
+        outcomes = []
+        for voter, poll, grades in ballots:
+            try:
+                outcomes.append(self.write_ballot(voter, poll, grades))
+            except Exception as error:
+                outcomes.append(error)
+        return outcomes
+
+    def write_ballots(self, poll, ballots):
+        """
+        Add or replace ballots of a poll and update its tallies, atomically
+
+        :param ballots: [(voter, poll, choice_id, grade),], a grade replaces the previous ones of its voter and choice
+        :return: False if the poll has ended or has results, checked within the write: nothing is written then
+        """
+        raise NotImplementedError
+
+    def voters(self, poll, after=None, limit=None):
+        """:return: The voters of a poll by name, after a name and up to a number of voters if given"""
+        raise NotImplementedError
+
+    def count_voters(self, poll, choice):
+        """:return: The sum of the tallies of a choice"""
+        raise NotImplementedError
+
+    def read_tallies(self, poll):
+        """:return: The number of votes of each grade of each choice, iterable of (choice_id, grade, count)"""
+        raise NotImplementedError
+
+    def ended_polls(self, since, until):
+        """
+        :return: UIDs of the polls with tallies and without results which ended in a period (since is None for no
+                 lower bound)
+        """
+        raise NotImplementedError
+
+    def transaction(self, poll):
+        """:return: Context manager making the reads and writes of the results of a poll exclusive"""
+        raise NotImplementedError
+
+    def read_results(self, poll):
+        """:return: The results of a poll by rank, empty if they are not computed"""
+        raise NotImplementedError
+
+    def write_results(self, poll, results):
+        """Store the results of a poll and delete its ballots and tallies"""
+        raise NotImplementedError
+
+    def export_results(self, poll=None):
+        """
+        :param poll: UID of a poll, None for all the polls
+        :return: generator of the results by poll then by rank, with the title and end_date of their poll and the text
+                 of their choice
+        """
+        raise NotImplementedError
+
+
+class MemoryStorage(Storage):
+    """Storage in dicts of the process memory, guarded by a lock"""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        """Remove everything"""
+        with self.lock:
+            self.polls = {}
+            self.choices = {}
+            self.choice_id = 0
+            # Grades by voter then by choice, and voters sorted by name, by poll
+            self.ballots = defaultdict(dict)
+            self.sorted_voters = defaultdict(list)
+            # Number of votes by (choice, grade) by poll
+            self.tallies = defaultdict(lambda: defaultdict(int))
+            self.results = {}
+
+    def init(self):
+        pass
+
+    def insert_poll(self, poll, choices):
+        with self.lock:
+            self.polls[poll['uid']] = dict(poll)
+            self.choices[poll['uid']] = []
+            for text, html in choices:
+                self.choice_id += 1
+                self.choices[poll['uid']].append({'id': self.choice_id, 'poll': poll['uid'], 'text': text, 'html': html})
+
+    def read_poll(self, poll):
+        with self.lock:
+            if poll not in self.polls:
+                return None
+            return dict(self.polls[poll], choices=[dict(choice) for choice in self.choices[poll]])
+
+    def set_end_date(self, poll, end_date):
+        with self.lock:
+            if poll in self.polls:
+                self.polls[poll]['end_date'] = end_date
+
+    def owner_polls(self, owner):
+        with self.lock:
+            return [dict(poll) for poll in self.polls.values() if poll['owner'] == owner]
+
+    def voter_polls(self, voter):
+        with self.lock:
+            return [self.read_poll(poll) for poll, ballots in self.ballots.items() if voter in ballots]
+
+    def delete_poll(self, poll):
+        with self.lock:
+            for table in (self.polls, self.choices, self.ballots, self.sorted_voters, self.tallies, self.results):
+                table.pop(poll, None)
+
+    def read_ballot(self, voter, poll):
+        with self.lock:
+            return dict(self.ballots[poll].get(voter, {})) if poll in self.ballots else {}
+
+    def add_ballot(self, voter, poll, grades):
+        """Add or replace a ballot, :return: the grades it replaces"""
+        ballots = self.ballots[poll]
+        if voter not in ballots:
+            bisect.insort(self.sorted_voters[poll], voter)
+        previous = ballots.get(voter, {})
+        ballots[voter] = dict(previous)
+        ballots[voter].update(grades)
+        return previous
+
+    def is_open(self, poll):
+        """:return: True if a poll accepts ballots: it has not ended and has no results"""
+        return poll in self.polls and self.polls[poll]['end_date'] > datetime.now() and poll not in self.results
+
+    def tally_ballot(self, voter, poll, grades):
+        """Add or replace a ballot and update the tallies"""
+        tallies = self.tallies[poll]
+        previous = self.add_ballot(voter, poll, grades)
+        for choice, grade in grades.items():
+            if choice in previous:
+                tallies[(choice, previous[choice])] -= 1
+            tallies[(choice, grade)] += 1
+
+    def write_ballot(self, voter, poll, grades):
+        with self.lock:
+            if not self.is_open(poll):
+                return False
+            self.tally_ballot(voter, poll, grades)
+            return True
+
+    def write_ballots(self, poll, ballots):
+        with self.lock:
+            if not self.is_open(poll):
+                return False
+            for voter, _, choice, grade in ballots:
+                self.tally_ballot(voter, poll, {choice: grade})
+            return True
+
+    def voters(self, poll, after=None, limit=None):
+        with self.lock:
+            voters = self.sorted_voters.get(poll, [])
+            start = bisect.bisect_right(voters, after) if after else 0
+            return voters[start:start + limit] if limit is not None else voters[start:]
+
+    def count_voters(self, poll, choice):
+        with self.lock:
+            return sum(count for (tally_choice, _), count in self.tallies.get(poll, {}).items() if tally_choice == choice)
+
+    def read_tallies(self, poll):
+        with self.lock:
+            return [(choice, grade, count) for (choice, grade), count in self.tallies.get(poll, {}).items()]
+
+    def ended_polls(self, since, until):
+        with self.lock:
+            polls = [poll for poll in self.polls.values() if (since is None or poll['end_date'] > since) and poll['end_date'] <= until and self.tallies.get(poll['uid']) and poll['uid'] not in self.results]
+            return [poll['uid'] for poll in sorted(polls, key=lambda poll: poll['end_date'])]
+
+    def transaction(self, poll):
+        return self.lock
+
+    def read_results(self, poll):
+        with self.lock:
+            return [copy_result(result) for result in self.results.get(poll, [])]
+
+    def write_results(self, poll, results):
+        with self.lock:
+            self.results[poll] = sorted((copy_result(result) for result in results), key=lambda result: (result['rank'], result['choice']))
+            for table in (self.ballots, self.sorted_voters, self.tallies):
+                table.pop(poll, None)
+
+    def export_results(self, poll=None):
+        with self.lock:
+            polls = sorted(self.results) if poll is None else [poll]
+
+        for poll in polls:
+            with self.lock:
+                if poll not in self.polls or poll not in self.results:
+                    continue
+                texts = dict((choice['id'], choice['text']) for choice in self.choices[poll])
+                rows = [dict(copy_result(result), poll=poll, title=self.polls[poll]['title'], end_date=self.polls[poll]['end_date'], text=texts[result['choice']]) for result in self.results[poll]]
+            for row in rows:
+                yield row
@@ -1,16 +1,17 @@
 # coding: utf-8
 """Manage the differents pages of the site"""
 
-import markdown
-import bleach
-from urlparse import urlparse
+import time
+import hashlib
 from datetime import datetime
 
-from flask import Flask, render_template, request, flash, redirect, url_for
+from flask import Flask, Response, render_template, request, flash, redirect, url_for, make_response, stream_with_context, abort
 from flask_babel import gettext, format_datetime
 
 from mjpoll import app, babel
-from data import get_poll, get_results, get_voter_ballot, add_update_ballot, get_own_polls, get_participate_polls, delete_poll, insert_poll, get_ballot_voters
+from markup import md_message, md_choice
+from data import get_poll, get_results, get_live_results, get_voter_ballot, add_update_ballot, get_own_polls, get_participate_polls, delete_poll, insert_poll, count_voters, results_page_cache, export_results
+from export import WRITERS, MIMETYPES
 
 USER = 'Bob' #TODO
 
@@ -19,27 +20,33 @@ def sort_choices_with_rank(choice_with_rank):
     return choice_with_rank[1]
 
 
+def choices_by_rank(results):
+    """
+    :param results: Results from get_results function
+    :return: The choices sorted by rank
+    """
+    choices_with_rank = []
+    for choice, result in results.items():
+        choices_with_rank.append([choice, result['rank'][0] if isinstance(result['rank'], list) else result['rank']])
+    choices_with_rank.sort(key=sort_choices_with_rank)
+    return [choice_with_rank[0] for choice_with_rank in choices_with_rank]
+
+
 @babel.localeselector
 def get_locale():
     return request.accept_languages.best_match(app.config['LANGUAGES'].keys())
 
 
-def set_target(attrs, new=False):
-    p = urlparse(attrs['href'])
-    attrs['target'] = '_blank'
-    return attrs
-
-
 @app.template_filter('md_message')
 def md_message_filter(s):
     """Filter that convert to markdown and allow only tag legal for messages"""
-    return bleach.linkify(bleach.clean(markdown.markdown(s), tags=['strong', 'em', 'a', 'ul', 'li', 'p', 'br'], strip=True), callbacks=[set_target])
+    return md_message(s)
 
 
 @app.template_filter('md_choice')
 def md_choice_filter(s):
     """Filter that convert to markdown and allow only tag legal for choices"""
-    return bleach.linkify(bleach.clean(markdown.markdown(s), tags=['strong', 'em', 'a'], strip=True), callbacks=[set_target])
+    return md_choice(s)
 
 
 @app.route('/')
@@ -67,6 +74,46 @@ def delete(poll):
     return redirect(url_for('list_poll'))
 
 
+@app.route('/live/<poll>')
+def live_results(poll):
+    """Display the results of an open poll to its owner"""
+
+    poll = get_poll(poll)
+
+    if poll is None:
+        return render_template('error.html', message=gettext(u'Error: poll do not exits'))
+
+    if not app.config['LIVE_RESULTS'] or poll['owner'] != USER:
+        return render_template('error.html', message=gettext(u'Error: live results not allowed'))
+
+    if poll['closed']:
+        return redirect(url_for('ballot_or_results', poll=poll['uid']))
+
+    results = get_live_results(poll)
+
+    if results is None:
+        return render_template('error.html', message=gettext(u'Error: poll with not results'))
+
+    poll['end_date'] = format_datetime(poll['end_date'])
+    return render_template('results.html', poll=poll, results=results, choices_by_rank=choices_by_rank(results), choices=dict((choice['id'], choice) for choice in poll['choices']), live=True)
+
+
+@app.route('/export/results.<file_format>')
+def results_export(file_format):
+    """Stream the results of the closed polls given by the poll arguments, or of all the closed polls of the user"""
+
+    if file_format not in WRITERS:
+        abort(404)
+
+    polls = request.args.getlist('poll')
+    if not polls:
+        polls = [poll['uid'] for poll in get_own_polls(USER) or [] if poll['closed']]
+
+    response = Response(stream_with_context(WRITERS[file_format](export_results(polls))), mimetype=MIMETYPES[file_format])
+    response.headers['Content-Disposition'] = 'attachment; filename=results.%s' % file_format
+    return response
+
+
 @app.route('/cast', methods=['POST'])
 def cast():
     if request.method == 'POST':
@@ -159,6 +206,41 @@ def save():
         return render_template('error.html', message=gettext(u'Error: poll without data'))
 
 
+def results_page(poll):
+    """
+    Display the results page of a closed poll.
+
+    The page never changes once rendered, so it is cached and served with validators allowing clients to revalidate it.
+    """
+
+    locale = str(get_locale())
+    pages = results_page_cache.get(poll['uid'])
+    page = pages.get(locale) if pages is not None else None
+
+    if page is None:
+        results = get_results(poll)
+
+        if results is None:
+            return render_template('error.html', message=gettext(u'Error: poll with not results'))
+
+        # The end dates are local, HTTP dates are in UTC
+        last_modified = datetime.utcfromtimestamp(time.mktime(poll['end_date'].timetuple()))
+        poll['end_date'] = format_datetime(poll['end_date'])
+        html = render_template('results.html', poll=poll, results=results, choices_by_rank=choices_by_rank(results), choices=dict((choice['id'], choice) for choice in poll['choices']))
+        page = {'html': html, 'etag': hashlib.sha1(html.encode('utf-8')).hexdigest(), 'last_modified': last_modified}
+
+        if pages is None:
+            pages = {}
+            results_page_cache.set(poll['uid'], pages)
+        pages[locale] = page
+
+    response = make_response(page['html'])
+    response.set_etag(page['etag'])
+    response.last_modified = page['last_modified']
+    response.vary.add('Accept-Language')
+    return response.make_conditional(request)
+
+
 @app.route('/<poll>')
 def ballot_or_results(poll):
     """IF the poll is open, display the ballot page. Otherwise display the results page"""
@@ -168,31 +250,16 @@ def ballot_or_results(poll):
     if poll is None:
         return render_template('error.html', message=gettext(u'Error: poll do not exits'))
     else:
-        poll['end_date'] = format_datetime(poll['end_date'])
         if poll['closed']:
-            results = get_results(poll)
-
-            if results is None:
-                return render_template('error.html', message=gettext(u'Error: poll with not results'))
-
-            choices_by_rank = []
-            choices_with_rank = []
-            for choice, result in results.items():
-                choices_with_rank.append([choice, result['rank'][0] if isinstance(result['rank'], list) else result['rank']])
-            choices_with_rank.sort(key=sort_choices_with_rank)
-            choices_by_rank = [choice_with_rank[0] for choice_with_rank in choices_with_rank]
-
-            return render_template('results.html', poll=poll, results=results, choices_by_rank=choices_by_rank)
+            return results_page(poll)
         else:
+            poll['end_date'] = format_datetime(poll['end_date'])
+
             ballot = get_voter_ballot(USER, poll['uid'])
-            voters = get_ballot_voters(poll['uid'])
 
             if ballot is None:
                 ballot = {}
                 for choice in poll['choices']:
                     ballot[choice['id']] = 0
-            
-            if voters is None:
-                voters = []
 
-            return render_template('ballot.html', poll=poll, ballot=ballot, voters=voters)
+            return render_template('ballot.html', poll=poll, ballot=ballot, voters_count=count_voters(poll))